@@ -1,18 +1,66 @@
-from telebot import TeleBot, types
+from telebot import types
 from logic import *
-import schedule
+from broadcast import Broadcaster, classify_error
+from drops import DropRegistry
+from scheduler import IntervalScheduler, DailyScheduler
+from outbox import OutboxWorker
+from collage import CollageService
+from catalog import CatalogService
+from ledger import LedgerReconciler
+from dispatcher import DispatchingTeleBot, UpdateDispatcher
+from webhook import WebhookServer
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
 import threading
 import time
 from config import *
 import os
-import cv2
-import tempfile
-import json
-from datetime import datetime
-
-bot = TeleBot(API_TOKEN)
+import hashlib
+import sys
+
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL
+
+HEAVY_COMMANDS = {'/myscore', '/get_my_score'}
+
+def update_lane(update):
+    call = update.callback_query
+    if call and call.data:
+        if call.data.startswith('prize_'):
+            return 'prize'
+        if call.data.startswith('resend_'):
+            return 'heavy'
+    message = update.message
+    if message and message.text and message.text.split()[0].split('@')[0] in HEAVY_COMMANDS:
+        return 'heavy'
+    return 'default'
+
+bot = DispatchingTeleBot(API_TOKEN, threaded=False)
 manager = DatabaseManager(DATABASE)
 
+def handle_update(update):
+    source = update.message or update.callback_query
+    if source and source.from_user:
+        manager.touch_user(source.from_user.id)
+    bot.handle_update(update)
+
+bot.dispatcher = UpdateDispatcher(handle_update, DISPATCH_LANES, update_lane)
+broadcaster = Broadcaster(BROADCAST_WORKERS, BROADCAST_GLOBAL_RATE, BROADCAST_CHAT_RATE)
+drops = DropRegistry(manager)
+collages = CollageService(manager)
+ledger = LedgerReconciler(manager, LEDGER_ARCHIVE, LEDGER_ARCHIVE_DAYS, LEDGER_CHUNK_SIZE)
+drop_scheduler = None
+bonus_scheduler = None
+ledger_scheduler = None
+second_chance_stats = None
+upload_lock = threading.Lock()
+
+BONUS_SEGMENTS = {
+    'all': ("все пользователи", None),
+    'active': (f"активные за {BONUS_ACTIVE_DAYS} дн.", BONUS_ACTIVE_DAYS),
+    'top': (f"топ-{BONUS_TOP_USERS} по монетам", BONUS_TOP_USERS),
+}
+
 def gen_markup(prize_id):
     markup = types.InlineKeyboardMarkup()
     markup.row_width = 1
@@ -36,50 +84,108 @@ def gen_admin_markup():
     markup.row("❌ Закрыть админ-панель")
     return markup
 
+def send_prize_photo(chat_id, img_name, hidden=False, **kwargs):
+    file_id = manager.get_file_id(img_name, hidden)
+    if file_id is None:
+        with upload_lock:
+            file_id = manager.get_file_id(img_name, hidden)
+            if file_id is None:
+                folder = 'hidden_img' if hidden else 'img'
+                with open(f'{folder}/{img_name}', 'rb') as photo:
+                    sent_msg = broadcaster.send(chat_id, bot.send_photo, photo, **kwargs)
+                manager.set_file_id(img_name, hidden, sent_msg.photo[-1].file_id)
+                return sent_msg
+    
+    try:
+        return broadcaster.send(chat_id, bot.send_photo, file_id, **kwargs)
+    except ApiTelegramException as e:
+        if e.error_code != 400 or 'file' not in e.description.lower():
+            raise
+        manager.clear_file_id(img_name, hidden)
+        return send_prize_photo(chat_id, img_name, hidden, **kwargs)
+
+def refresh_hidden_img(img_name):
+    if hidden_images.ensure(img_name):
+        manager.clear_file_id(img_name, hidden=True)
+        return True
+    return False
+
+def warm_hidden_images():
+    for img in hidden_images.warm(os.listdir('img')):
+        manager.clear_file_id(img, hidden=True)
+    print(hidden_images.report())
+    print(f"🧩 Плиток коллажа загружено: {collages.warm()}")
+
 def send_message():
     result = manager.get_random_prize()
     if result:
         prize_id, img = result[:2]
-        manager.mark_prize_used(prize_id)
-        hide_img(img)
-        
-        users = manager.get_users()
-        for user in users:
-            try:
-                with open(f'hidden_img/{img}', 'rb') as photo:
-                    sent_msg = bot.send_photo(
-                        user, 
-                        photo, 
-                        caption=f"🎯 Новый приз доступен!\nТолько 3 первых получат его!\n",
-                        reply_markup=gen_markup(prize_id)
-                    )
-                    
-                    if bonus_time_active():
-                        bot.send_message(
-                            user,
-                            f"🌟 БОНУСНОЕ ВРЕМЯ! 🌟\n"
-                            f"Сейчас {datetime.now().hour}:00 - время для повторной попытки!\n"
-                            f"Проверь /failedprizes чтобы получить второй шанс!"
-                        )
-                    
-            except Exception as e:
-                print(f"Ошибка отправки пользователю {user}: {e}")
-                manager.add_failed_prize(user, prize_id)
-
-def bonus_time_active():
-    try:
-        hour = int(manager.get_setting('bonus_time_hour', '22'))
-        return manager.get_setting('bonus_time_enabled', 'true').lower() == 'true' and datetime.now().hour == hour
-    except:
-        return False
+        refresh_hidden_img(img)
+        drops.start(prize_id, manager.get_int_setting('max_winners_per_prize'))
+        count = manager.start_drop(prize_id)
+        catalog.invalidate()
+        print(f"Приз #{prize_id} поставлен в очередь рассылки для {count} пользователей")
+        outbox_worker.notify()
+
+def deliver_prize(row):
+    prize_id, user, img = row[:3]
+    send_prize_photo(
+        user,
+        img,
+        hidden=True,
+        caption=f"🎯 Новый приз доступен!\nТолько 3 первых получат его!\n",
+        reply_markup=gen_markup(prize_id)
+    )
 
-def shedule_thread():
-    interval = int(manager.get_setting('send_interval_hours', '1'))
-    schedule.every(interval).hours.do(send_message)
+outbox_worker = OutboxWorker(manager, broadcaster, deliver_prize, OUTBOX_BATCH_SIZE, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_SECONDS,
+                             INACTIVE_AFTER_FAILURES, OUTBOX_KEEP_DROPS)
+
+def broadcast_and_prune(items, job, user_of=lambda item: item):
+    undeliverable = []
+    
+    def on_error(item, e):
+        if classify_error(e) in PERMANENT_ERRORS:
+            undeliverable.append(user_of(item))
+    
+    stats = broadcaster.broadcast(items, job, on_error)
+    if undeliverable:
+        manager.mark_undeliverable(undeliverable, INACTIVE_AFTER_FAILURES)
+    return stats
+
+def resend_prize(prize_id, img_name):
+    def send_prize(user):
+        send_prize_photo(
+            user,
+            img_name,
+            hidden=True,
+            caption=f"🔄 ПОВТОРНАЯ ОТПРАВКА\nПриз #{prize_id}",
+            reply_markup=gen_markup(prize_id)
+        )
+    
+    return broadcast_and_prune(manager.get_users(), send_prize)
+
+def send_second_chance():
+    global second_chance_stats
+    if not manager.is_bonus_time():
+        return
     
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    targets = manager.get_second_chance_targets()
+    for img in {row[3] for row in targets}:
+        refresh_hidden_img(img)
+    
+    def send_offer(row):
+        user, missed, prize_id, img = row
+        send_prize_photo(
+            user,
+            img,
+            hidden=True,
+            caption=f"🌟 БОНУСНОЕ ВРЕМЯ! 🌟\n"
+                    f"У тебя {missed} пропущенных призов — это твой второй шанс!\n"
+                    f"Загляни в /failedprizes и забери их со скидкой"
+        )
+    
+    second_chance_stats = broadcast_and_prune(targets, send_offer, lambda row: row[0])
+    print(f"Бонусное время: второй шанс отправлен\n{second_chance_stats.report()}")
 
 @bot.message_handler(commands=['help'])
 def handle_help(message):
@@ -119,10 +225,10 @@ def handle_start(message):
     user_id = message.chat.id
     username = message.from_user.username or message.from_user.first_name
     
-    manager.add_user(user_id, username)
+    is_new = manager.add_user(user_id, username)
     
-    interval = manager.get_setting('send_interval_hours', '1')
-    coins_per_win = manager.get_setting('coins_per_win', '10')
+    interval = manager.get_int_setting('send_interval_hours')
+    coins_per_win = manager.get_int_setting('coins_per_win')
     
     welcome_text = f"""
 🎮 *Добро пожаловать в PRIZE BOT, {username}!* 🎮
@@ -175,9 +281,8 @@ def handle_start(message):
     
     bot.send_message(user_id, welcome_text, parse_mode='Markdown', disable_web_page_preview=True)
 
-    coins = manager.get_coins(user_id)
-    if coins == 0:
-        manager.add_coins(user_id, 20)
+    if is_new:
+        manager.add_coins(user_id, 20, 'newbie_bonus')
         bot.send_message(
             user_id,
             f"🎁 *БОНУС НОВИЧКА!*\nТы получил *20 стартовых монет*!\n"
@@ -191,40 +296,125 @@ def handle_coins(message):
     coins = manager.get_coins(user_id)
     bot.send_message(user_id, f"💰 Твой баланс: {coins} монет\n\n🏆 Зарабатывай монеты побеждая в розыгрышах!")
 
+def gen_page_markup(prefix, rows, has_prev, has_next, cursor_of):
+    markup = types.InlineKeyboardMarkup()
+    for row in rows:
+        markup.row(types.InlineKeyboardButton(f"🛒 Приз #{row[0]} — {row[-1]} монет", callback_data=f"buy_{row[0]}"))
+    nav = []
+    if rows and has_prev:
+        nav.append(types.InlineKeyboardButton("◀️ Назад", callback_data=f"{prefix}_p_{cursor_of(rows[0])}"))
+    if rows and has_next:
+        nav.append(types.InlineKeyboardButton("Вперед ▶️", callback_data=f"{prefix}_n_{cursor_of(rows[-1])}"))
+    if nav:
+        markup.row(*nav)
+    return markup
+
+def render_shop_rows(rows, has_prev, has_next):
+    text = ""
+    for prize_id, image, price in rows:
+        text += f"🎁 Приз #{prize_id}\n💵 Цена: {price} монет\n/image_{prize_id} - посмотреть\n/buy_{prize_id} - купить\n\n"
+    
+    markup = gen_page_markup('shop', rows, has_prev, has_next, lambda row: f"{row[2]}_{row[0]}")
+    return text, markup
+
+catalog = CatalogService(manager, render_shop_rows, PAGE_SIZE)
+
+def render_shop_page(user_id, cursor=None, backward=False):
+    body, markup = catalog.page(cursor, backward)
+    if not body:
+        return None, None
+    
+    return f"🛒 МАГАЗИН ПРИЗОВ\n💰 Твой баланс: {manager.get_coins(user_id)} монет\n\n{body}", markup
+
+def render_failed_page(user_id, cursor=None, backward=False):
+    rows, has_prev, has_next = manager.get_failed_prizes_page(user_id, cursor, backward, PAGE_SIZE)
+    if not rows:
+        return None, None
+    
+    discount = manager.get_int_setting('failed_prize_discount')
+    text = f"""🔄 <b>ПРОПУЩЕННЫЕ ПРИЗЫ - ВТОРОЙ ШАНС!</b> 🔄
+
+💰 <b>Твой баланс:</b> <code>{manager.get_coins(user_id)} монет</code>
+
+🎯 <b>Это твой второй шанс получить призы, которые ты пропустил!</b>
+🛒 <b>Скидка {discount}% на все пропущенные призы!</b>
+"""
+    if manager.is_bonus_time():
+        text += f"🌟 <b>Бонусное время: еще -{manager.get_int_setting('bonus_time_discount')}%!</b>\n"
+    
+    text += "\n<b>Доступные призы:</b>\n"
+    for prize_id, image, base_price, price in rows:
+        text += f"\n🎁 <b>Приз #{prize_id}</b>\n"
+        text += f"💵 Цена: <s>{base_price}</s> → <b>{price} монет</b>\n"
+        text += f"🛒 Купить: <code>/buy_{prize_id}</code>\n"
+    
+    text += """
+<b>💡 Как купить:</b>
+Нажми кнопку под сообщением или используй команду <code>/buy_номер</code>
+
+<b>Не упусти второй шанс!</b> 🚀
+"""
+    
+    markup = gen_page_markup('failed', rows, has_prev, has_next, lambda row: row[0])
+    return text, markup
+
 @bot.message_handler(commands=['shop'])
 def handle_shop(message):
     user_id = message.chat.id
-    prizes = manager.get_available_prizes()
+    text, markup = render_shop_page(user_id)
     
-    if not prizes:
+    if not text:
         bot.send_message(user_id, "🛒 Магазин пуст. Новые призы скоро появятся!")
         return
     
-    coins = manager.get_coins(user_id)
-    text = f"🛒 МАГАЗИН ПРИЗОВ\n💰 Твой баланс: {coins} монет\n\n"
+    bot.send_message(user_id, text, reply_markup=markup)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('shop_'))
+def callback_shop(call):
+    _, direction, price, prize_id = call.data.split('_')
+    text, markup = render_shop_page(call.from_user.id, (int(price), int(prize_id)), direction == 'p')
+    if text:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    bot.answer_callback_query(call.id)
+
+@bot.message_handler(func=lambda message: message.text and message.text.startswith('/image_'))
+def handle_image(message):
+    try:
+        prize_id = int(message.text.split()[0].split('@')[0].split('_')[1])
+    except ValueError:
+        bot.reply_to(message, "❌ Формат: /image_номер")
+        return
     
-    for prize_id, image, price in prizes:
-        text += f"🎁 Приз #{prize_id}\n💵 Цена: {price} монет\n/image_{prize_id} - посмотреть\n/buy_{prize_id} - купить\n\n"
+    key, thumb = catalog.thumbnail(prize_id, message.chat.id)
+    if not thumb:
+        bot.reply_to(message, "❌ Приз не найден")
+        return
     
-    bot.send_message(user_id, text)
+    caption = f"🎁 Приз #{prize_id}\n/buy_{prize_id} - купить"
+    file_id = catalog.get_thumb_file_id(key)
+    if file_id:
+        bot.send_photo(message.chat.id, file_id, caption=caption)
+    else:
+        sent = bot.send_photo(message.chat.id, thumb, caption=caption)
+        catalog.set_thumb_file_id(key, sent.photo[-1].file_id)
 
-@bot.message_handler(commands=['buy_'])
+@bot.message_handler(func=lambda message: message.text and message.text.startswith('/buy_'))
 def handle_buy_command(message):
     try:
-        prize_id = int(message.text.split('_')[1])
+        prize_id = int(message.text.split()[0].split('@')[0].split('_')[1])
         user_id = message.chat.id
         
-        success, result_msg = manager.buy_prize(user_id, prize_id)
+        success, result_msg = manager.buy_prize(user_id, prize_id, f"msg:{message.chat.id}:{message.message_id}")
         
         if success:
+            catalog.invalidate()
             img_name = manager.get_prize_img(prize_id)
-            with open(f'img/{img_name}', 'rb') as photo:
-                bot.send_photo(
-                    user_id,
-                    photo,
-                    caption=f"🎉 Поздравляем с покупкой!\n{result_msg}",
-                    parse_mode='HTML'
-                )
+            send_prize_photo(
+                user_id,
+                img_name,
+                caption=f"🎉 Поздравляем с покупкой!\n{result_msg}",
+                parse_mode='HTML'
+            )
         else:
             bot.send_message(user_id, f"❌ {result_msg}")
     except Exception as e:
@@ -233,9 +423,9 @@ def handle_buy_command(message):
 @bot.message_handler(commands=['failedprizes'])
 def handle_failed_prizes(message):
     user_id = message.chat.id
-    failed_prizes = manager.get_user_failed_prizes(user_id)
+    text, markup = render_failed_page(user_id)
     
-    if not failed_prizes:
+    if not text:
         bot.send_message(
             user_id,
             "✅ *У тебя нет пропущенных призов!*\n\n"
@@ -245,164 +435,127 @@ def handle_failed_prizes(message):
         )
         return
     
-    coins = manager.get_coins(user_id)
-    
-    text = f"""
-🔄 *ПРОПУЩЕННЫЕ ПРИЗЫ - ВТОРОЙ ШАНС!* 🔄
+    bot.send_message(user_id, text, parse_mode='HTML', reply_markup=markup)
 
-💰 *Твой баланс:* `{coins} монет`
-
-🎯 *Это твой второй шанс получить призы, которые ты пропустил!*
-🛒 *Скидка 40% на все пропущенные призы!*
-
-*Доступные призы:*
-"""
-    
-    for prize_id, img_name in failed_prizes[:5]:
-        discount_price = 30
-        text += f"\n🎁 *Приз #{prize_id}*\n"
-        text += f"💵 Цена: ~~50~~ → *{discount_price} монет* (скидка 40%!)\n"
-        text += f"🛒 Купить: `/buy_{prize_id}`\n"
-    
-    if len(failed_prizes) > 5:
-        text += f"\n*...и еще {len(failed_prizes)-5} призов*\n"
-    
-    text += """
-*💡 Как купить:*
-Просто используй команду `/buy_номер`
-Например: `/buy_3`
+@bot.callback_query_handler(func=lambda call: call.data.startswith('failed_'))
+def callback_failed(call):
+    _, direction, prize_id = call.data.split('_')
+    text, markup = render_failed_page(call.from_user.id, int(prize_id), direction == 'p')
+    if text:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='HTML', reply_markup=markup)
+    bot.answer_callback_query(call.id)
 
-*🎁 Что дают монеты?*
-• Покупай пропущенные призы
-• Выбирай любимые картинки
-• Пополняй коллекцию
+RATING_TITLES = {
+    'prizes': ("🏆 ТОП-10 ИГРОКОВ 🏆", "призов", "🏆 Призы"),
+    'coins': ("💰 ТОП-10 ПО МОНЕТАМ 💰", "монет", "💰 Монеты"),
+    'purchases': ("🛒 ТОП-10 ПОКУПАТЕЛЕЙ 🛒", "покупок", "🛒 Покупки"),
+    'weekly': ("📅 ТОП-10 НЕДЕЛИ 📅", "призов", "📅 Неделя"),
+}
 
-*Не упусти второй шанс!* 🚀
-"""
-    
-    bot.send_message(user_id, text, parse_mode='Markdown')
+def gen_rating_markup(board):
+    markup = types.InlineKeyboardMarkup()
+    markup.row(*[
+        types.InlineKeyboardButton(f"• {label}" if key == board else label, callback_data=f"rating_{key}")
+        for key, (_, _, label) in RATING_TITLES.items()
+    ])
+    return markup
 
-@bot.message_handler(commands=['rating'])
-def handle_rating(message):
-    rating_data = manager.get_rating()
+def render_rating(user_id, board='prizes'):
+    title, unit, _ = RATING_TITLES[board]
+    rating_data = manager.get_rating(board)
     
     if rating_data:
-        text = "🏆 ТОП-10 ИГРОКОВ 🏆\n\n"
+        text = f"{title}\n\n"
         for i, (username, count) in enumerate(rating_data, 1):
             medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-            text += f"{medal} {username:<15} - {count:>3} призов\n"
+            text += f"{medal} {username:<15} - {count:>3} {unit}\n"
     else:
-        text = "📊 Рейтинг пока пуст. Стань первым!"
+        text = "📊 Рейтинг пока пуст. Стань первым!\n"
     
-    bot.send_message(message.chat.id, text)
+    rank, value = manager.get_user_rank(user_id, board)
+    text += f"\n📍 Твое место: {rank} ({value} {unit})"
+    return text
+
+@bot.message_handler(commands=['rating'])
+def handle_rating(message):
+    bot.send_message(message.chat.id, render_rating(message.chat.id), reply_markup=gen_rating_markup('prizes'))
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('rating_'))
+def callback_rating(call):
+    board = call.data.split('_', 1)[1]
+    if board not in RATING_TITLES:
+        bot.answer_callback_query(call.id)
+        return
+    
+    try:
+        bot.edit_message_text(
+            render_rating(call.from_user.id, board),
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            reply_markup=gen_rating_markup(board)
+        )
+    except ApiTelegramException:
+        pass
+    bot.answer_callback_query(call.id)
 
 @bot.message_handler(commands=['myscore'])
 def handle_my_score(message):
     user_id = message.chat.id
     
-    if user_id not in manager.get_users():
+    if not manager.is_registered(user_id):
         bot.reply_to(message, "❌ Сначала зарегистрируйтесь /start")
         return
     
     bot.send_message(message.chat.id, "🖼️ Создаю твою коллекцию...")
     
-    collage = create_collage_for_user(user_id)
-    
-    if collage is None:
-        bot.send_message(message.chat.id, "📭 У тебя еще нет призов!")
-        return
-    
-    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp_file:
-        temp_filename = tmp_file.name
-        cv2.imwrite(temp_filename, collage)
+    def send_collage(collage, error):
+        if collage is None:
+            if error:
+                print(f"Ошибка создания коллажа для {user_id}: {error}")
+            bot.send_message(message.chat.id, "📭 У тебя еще нет призов!")
+            return
+        
+        coins = manager.get_coins(user_id)
+        
+        caption = f"🎨 ТВОЯ КОЛЛЕКЦИЯ\n\n"
+        caption += f"🏆 Призов: {collage.prize_count}\n"
+        caption += f"💰 Монет: {coins}\n"
+        caption += f"🔓 Оригинал - твои призы\n"
+        caption += f"🔒 Зашифровано - еще можно получить!"
+        
+        bot.send_photo(message.chat.id, collage.jpeg, caption=caption)
     
-    try:
-        with open(temp_filename, 'rb') as photo:
-            user_prizes = manager.get_winners_img(user_id)
-            prize_count = len(user_prizes) if user_prizes else 0
-            coins = manager.get_coins(user_id)
-            
-            caption = f"🎨 ТВОЯ КОЛЛЕКЦИЯ\n\n"
-            caption += f"🏆 Призов: {prize_count}\n"
-            caption += f"💰 Монет: {coins}\n"
-            caption += f"🔓 Оригинал - твои призы\n"
-            caption += f"🔒 Зашифровано - еще можно получить!"
-            
-            bot.send_photo(message.chat.id, photo, caption=caption)
-    finally:
-        os.unlink(temp_filename)
+    collages.render_async(user_id, send_collage)
 
 @bot.message_handler(commands=['get_my_score'])
 def handle_get_my_score(message):
     user_id = message.chat.id
     
-    if user_id not in manager.get_users():
+    if not manager.is_registered(user_id):
         bot.send_message(user_id, "❌ Сначала зарегистрируйтесь: /start")
         return
     
-    info = manager.get_winners_img(user_id)
-    prizes = [x[0] for x in info] if info else []
-    
-    all_images = os.listdir('img')
-    
-    image_paths = []
-    for img in all_images:
-        if img in prizes:
-            path = f'img/{img}'
-        else:
-            path = f'hidden_img/{img}'
-        
-        if os.path.exists(path):
-            image_paths.append(path)
-    
-    if not image_paths:
+    if not collages.get_catalog():
         bot.send_message(user_id, "❌ Нет доступных изображений для создания коллажа.")
         return
     
     bot.send_message(user_id, "🖼️ Создаю ваш коллаж...")
     
-    collage = create_collage(image_paths)
-    
-    if collage is not None:
-        temp_filename = f"temp_collage_{user_id}.jpg"
-        cv2.imwrite(temp_filename, collage)
-        
-        with open(temp_filename, 'rb') as photo:
-            user_prizes = manager.get_winners_img(user_id)
-            prize_count = len(user_prizes) if user_prizes else 0
-            
+    def send_collage(collage, error):
+        if collage is not None:
             caption = f"🎯 ВАША КОЛЛЕКЦИЯ ПРИЗОВ\n\n"
-            caption += f"🏆 Получено призов: {prize_count}\n"
-            caption += f"📊 Всего доступно призов: {len(all_images)}\n"
+            caption += f"🏆 Получено призов: {collage.prize_count}\n"
+            caption += f"📊 Всего доступно призов: {collage.total}\n"
             caption += f"🔓 Четкие изображения - ваши призы\n"
             caption += f"🔒 Зашифрованные - еще можно получить!"
             
-            bot.send_photo(user_id, photo, caption=caption)
-        
-        os.remove(temp_filename)
-    else:
-        bot.send_message(user_id, "❌ Не удалось создать коллаж.")
-
-def create_collage_for_user(user_id):
-    info = manager.get_winners_img(user_id)
-    prizes = [x[0] for x in info] if info else []
-    
-    all_images = os.listdir('img')
-    
-    image_paths = []
-    for img in all_images:
-        if img in prizes:
-            path = f'img/{img}'
+            bot.send_photo(user_id, collage.jpeg, caption=caption)
         else:
-            path = f'hidden_img/{img}'
-        
-        if os.path.exists(path):
-            image_paths.append(path)
-    
-    if not image_paths:
-        return None
+            if error:
+                print(f"Ошибка создания коллажа для {user_id}: {error}")
+            bot.send_message(user_id, "❌ Не удалось создать коллаж.")
     
-    return create_collage(image_paths)
+    collages.render_async(user_id, send_collage)
 
 @bot.message_handler(commands=['admin'])
 def handle_admin(message):
@@ -425,18 +578,27 @@ def handle_stats(message):
     if not manager.is_admin(message.chat.id):
         return
     
-    users_count = len(manager.get_users())
-    prizes_count = len(manager.get_all_prizes())
+    users_count = manager.count_users()
+    prizes_count = manager.count_prizes()
     unused_prizes = manager.get_unused_prizes_count()
     settings = manager.get_all_settings()
     
     text = "📊 СТАТИСТИКА БОТА\n\n"
-    text += f"👥 Пользователей: {users_count}\n"
+    text += f"👥 Пользователей: {users_count} (активных: {manager.count_active_users()})\n"
     text += f"🎁 Всего призов: {prizes_count}\n"
     text += f"📦 Осталось призов: {unused_prizes}\n"
     text += f"⏰ Интервал рассылки: {settings.get('send_interval_hours', '1')} ч.\n"
     text += f"🏆 Победителей за приз: {settings.get('max_winners_per_prize', '3')}\n"
     text += f"💰 Монет за победу: {settings.get('coins_per_win', '10')}\n"
+    if drop_scheduler:
+        text += f"\n{drop_scheduler.report()}\n"
+    if bonus_scheduler:
+        text += f"\n🌟 Второй шанс:\n{bonus_scheduler.report()}\n"
+    if second_chance_stats:
+        text += f"{second_chance_stats.report()}\n"
+    text += f"{hidden_images.report()}\n"
+    text += f"{catalog.report()}\n"
+    text += f"\n{bot.dispatcher.report()}\n"
     
     bot.send_message(message.chat.id, text)
 
@@ -457,6 +619,12 @@ def handle_photo(message):
             file_info = bot.get_file(file_id)
             downloaded_file = bot.download_file(file_info.file_path)
             
+            content_hash = hashlib.sha1(downloaded_file).hexdigest()
+            existing_id = manager.get_prize_by_hash(content_hash)
+            if existing_id:
+                bot.reply_to(message, f"♻️ Такое изображение уже есть: приз #{existing_id}")
+                return
+            
             filename = f"prize_{int(time.time())}.jpg"
             filepath = f"img/{filename}"
             
@@ -468,8 +636,11 @@ def handle_photo(message):
             except:
                 price = 50
             
-            prize_id = manager.add_prize(filename, user_id, price)
-            hide_img(filename)
+            prize_id = manager.add_prize(filename, user_id, price, content_hash)
+            manager.set_file_id(filename, False, file_id)
+            refresh_hidden_img(filename)
+            collages.invalidate_catalog()
+            catalog.invalidate()
             
             bot.reply_to(message, f"✅ Приз #{prize_id} добавлен!\nЦена: {price} монет\nФайл: {filename}")
         except Exception as e:
@@ -477,6 +648,78 @@ def handle_photo(message):
     else:
         bot.reply_to(message, "📸 Отличное фото! Но добавлять призы могут только админы.")
 
+@bot.message_handler(commands=['import'])
+def handle_import(message):
+    if not manager.is_admin(message.chat.id):
+        return
+    
+    parts = message.text.split()
+    if len(parts) < 2:
+        bot.reply_to(message, "❌ Формат: /import путь [цена]\nПуть - папка, zip или tar архив на сервере")
+        return
+    
+    source = parts[1]
+    price = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 50
+    status = bot.reply_to(message, f"📦 Импорт из {source} запущен...")
+    
+    def progress(text):
+        try:
+            bot.edit_message_text(text, message.chat.id, status.message_id)
+        except Exception:
+            pass
+    
+    def run_import():
+        try:
+            report = import_prizes(manager, source, message.chat.id, price, progress)
+            collages.invalidate_catalog()
+            catalog.invalidate()
+            bot.send_message(message.chat.id, report.report())
+        except Exception as e:
+            bot.send_message(message.chat.id, f"❌ Ошибка импорта: {e}")
+    
+    threading.Thread(target=run_import, daemon=True).start()
+
+@bot.message_handler(commands=['outbox'])
+def handle_outbox(message):
+    if not manager.is_admin(message.chat.id):
+        return
+    
+    bot.send_message(message.chat.id, outbox_worker.report())
+
+@bot.message_handler(commands=['ledger'])
+def handle_ledger(message):
+    if not manager.is_admin(message.chat.id):
+        return
+    
+    parts = message.text.split()
+    if len(parts) > 1 and parts[1] == 'run':
+        bot.reply_to(message, "📒 Сверка журнала запущена...")
+        threading.Thread(target=lambda: bot.send_message(message.chat.id, ledger.run().report()), daemon=True).start()
+        return
+    
+    if len(parts) > 1 and parts[1].lstrip('-').isdigit():
+        user_id = int(parts[1])
+        snapshot = manager.get_ledger_snapshot(user_id)
+        text = f"📒 Журнал пользователя {user_id}\n💰 Баланс: {manager.get_coins(user_id)} монет\n"
+        if snapshot:
+            balance, last_action_id, checked_at, discrepancy = snapshot
+            text += f"🧾 По журналу: {balance} (до записи #{last_action_id}, проверено {checked_at})\n"
+            text += f"⚠️ Расхождение: {discrepancy}\n" if discrepancy else "✅ Расхождений нет\n"
+        text += "\nПоследние операции:\n"
+        for action_id, action_type, coins_change, action_time in ledger.history(user_id):
+            text += f"#{action_id} {action_time} {action_type}: {coins_change:+d}\n"
+        bot.send_message(message.chat.id, text)
+        return
+    
+    text = ledger.report() + "\n"
+    discrepancies = manager.get_ledger_discrepancies()
+    if discrepancies:
+        text += "\n⚠️ Крупнейшие расхождения:\n"
+        for user_id, user_name, coins, balance, discrepancy in discrepancies:
+            text += f"• {user_name or user_id}: баланс {coins}, по журналу {balance} ({discrepancy:+d})\n"
+    text += "\n/ledger run - запустить сверку\n/ledger ID - история пользователя"
+    bot.send_message(message.chat.id, text)
+
 @bot.message_handler(func=lambda message: message.text == "⚙️ Настройки")
 def handle_settings(message):
     if not manager.is_admin(message.chat.id):
@@ -492,15 +735,22 @@ def handle_settings(message):
     
     bot.send_message(message.chat.id, text)
 
-@bot.message_handler(commands=['set_'])
+@bot.message_handler(func=lambda message: message.text and message.text.startswith('/set_'))
 def handle_set_setting(message):
     if not manager.is_admin(message.chat.id):
         return
     
     try:
-        parts = message.text[5:].split('_', 1)
+        parts = message.text[5:].rsplit('_', 1)
         if len(parts) == 2:
             key, value = parts
+            default = DEFAULT_SETTINGS.get(key)
+            if isinstance(default, bool) and value.lower() not in ('true', 'false'):
+                bot.reply_to(message, f"❌ '{key}' принимает значения true/false")
+                return
+            if isinstance(default, int) and not isinstance(default, bool) and not value.isdigit():
+                bot.reply_to(message, f"❌ '{key}' должно быть числом")
+                return
             manager.set_setting(key, value)
             bot.reply_to(message, f"✅ Настройка '{key}' изменена на '{value}'")
         else:
@@ -513,14 +763,15 @@ def handle_users(message):
     if not manager.is_admin(message.chat.id):
         return
     
-    users = manager.get_all_users()
+    users = manager.get_all_users(20)
+    users_count = manager.count_users()
     
     text = "👥 ПОЛЬЗОВАТЕЛИ\n\n"
-    for user_id, username, coins in users[:20]:
+    for user_id, username, coins in users:
         text += f"👤 {username or user_id}\n💰 {coins} монет\nID: {user_id}\n\n"
     
-    if len(users) > 20:
-        text += f"\n... и еще {len(users)-20} пользователей"
+    if users_count > 20:
+        text += f"\n... и еще {users_count-20} пользователей"
     
     bot.send_message(message.chat.id, text)
 
@@ -538,6 +789,10 @@ def handle_bonuses(message):
         types.InlineKeyboardButton("➕ 100 монет", callback_data="bonus_add_100"),
         types.InlineKeyboardButton("🎁 Всем по 10", callback_data="bonus_all_10")
     )
+    markup.row(
+        types.InlineKeyboardButton(f"🔥 Активным за {BONUS_ACTIVE_DAYS} дн. по 10", callback_data="bonus_active_10"),
+        types.InlineKeyboardButton(f"🏆 Топ-{BONUS_TOP_USERS} по 50", callback_data="bonus_top_50")
+    )
     
     bot.send_message(message.chat.id, "💰 УПРАВЛЕНИЕ БОНУСАМИ\nВыберите действие:", reply_markup=markup)
 
@@ -559,30 +814,28 @@ def callback_prize(call):
     prize_id = int(call.data.split('_')[1])
     user_id = call.from_user.id
     
-    winners_count = manager.get_winners_count(prize_id)
-    max_winners = int(manager.get_setting('max_winners_per_prize', '3'))
+    max_winners = manager.get_int_setting('max_winners_per_prize')
+    coins_per_win = manager.get_int_setting('coins_per_win')
+    result, remaining = drops.claim(user_id, prize_id, max_winners, coins_per_win)
     
-    if winners_count < max_winners:
-        success = manager.add_winner(user_id, prize_id)
-        
-        if success == 1:
+    if result != CLAIM_SOLD_OUT:
+        if result == CLAIM_WON:
             img_name = manager.get_prize_img(prize_id)
             
             if img_name:
-                with open(f'img/{img_name}', 'rb') as photo:
-                    bot.send_photo(
-                        user_id,
-                        photo,
-                        caption="🎉 *ПОЗДРАВЛЯЕМ С ВЫИГРЫШЕМ!*\n\n"
-                               f"🏆 Ты получил приз #{prize_id}\n"
-                               f"💰 *+10 монет* добавлены к твоему балансу!\n\n"
-                               f"*Что дальше?*\n"
-                               f"• Проверь баланс: `/coins`\n"
-                               f"• Посмотри коллекцию: `/myscore` или `/get_my_score`\n"
-                               f"• Магазин призов: `/shop`",
-                        parse_mode='Markdown'
-                    )
-                
+                send_prize_photo(
+                    user_id,
+                    img_name,
+                    caption="🎉 *ПОЗДРАВЛЯЕМ С ВЫИГРЫШЕМ!*\n\n"
+                           f"🏆 Ты получил приз #{prize_id}\n"
+                           f"💰 *+{coins_per_win} монет* добавлены к твоему балансу!\n\n"
+                           f"*Что дальше?*\n"
+                           f"• Проверь баланс: `/coins`\n"
+                           f"• Посмотри коллекцию: `/myscore` или `/get_my_score`\n"
+                           f"• Магазин призов: `/shop`",
+                    parse_mode='Markdown'
+                )
+            
                 bot.answer_callback_query(call.id, "🎁 Поздравляем с выигрышем!")
                 
                 try:
@@ -595,7 +848,7 @@ def callback_prize(call):
                         chat_id=call.message.chat.id,
                         message_id=call.message.message_id,
                         caption=f"✅ *Приз получен!*\n"
-                               f"Осталось мест: *{max_winners - winners_count - 1}/{max_winners}*",
+                               f"Осталось мест: *{remaining}/{max_winners}*",
                         parse_mode='Markdown'
                     )
                 except:
@@ -629,17 +882,17 @@ def callback_buy(call):
     prize_id = int(call.data.split('_')[1])
     user_id = call.from_user.id
     
-    success, result_msg = manager.buy_prize(user_id, prize_id)
+    success, result_msg = manager.buy_prize(user_id, prize_id, f"cb:{call.id}")
     
     if success:
+        catalog.invalidate()
         img_name = manager.get_prize_img(prize_id)
-        with open(f'img/{img_name}', 'rb') as photo:
-            bot.send_photo(
-                user_id,
-                photo,
-                caption=f"🎉 Поздравляем с покупкой!\n{result_msg}",
-                parse_mode='HTML'
-            )
+        send_prize_photo(
+            user_id,
+            img_name,
+            caption=f"🎉 Поздравляем с покупкой!\n{result_msg}",
+            parse_mode='HTML'
+        )
         bot.answer_callback_query(call.id, "✅ Приз куплен!")
     else:
         bot.answer_callback_query(call.id, f"❌ {result_msg}")
@@ -652,17 +905,33 @@ def callback_bonus(call):
     
     action = call.data
     
-    if action == "bonus_all_10":
-        users = manager.get_users()
-        for user in users:
-            manager.add_coins(user, 10)
-        bot.answer_callback_query(call.id, f"✅ Все {len(users)} пользователей получили по 10 монет!")
+    segment = action.split('_')[1]
+    if segment in BONUS_SEGMENTS:
+        amount = int(action.split('_')[2])
+        bot.answer_callback_query(call.id, "⏳ Начисление запущено...")
+        threading.Thread(target=process_bonus_bulk, args=(call.from_user.id, segment, amount), daemon=True).start()
     elif "bonus_add_" in action:
         amount = int(action.split('_')[2])
         bot.send_message(call.from_user.id, f"Введите ID пользователя для начисления {amount} монет:")
         bot.register_next_step_handler(call.message, lambda m: process_bonus_add(m, amount))
         bot.answer_callback_query(call.id, "✏️ Введите ID пользователя")
 
+def process_bonus_bulk(admin_id, segment, amount):
+    title, value = BONUS_SEGMENTS[segment]
+    started = time.perf_counter()
+    try:
+        count = manager.add_coins_bulk(amount, segment, value)
+    except Exception as e:
+        bot.send_message(admin_id, f"❌ Ошибка начисления: {e}")
+        return
+    bot.send_message(
+        admin_id,
+        f"✅ Начисление завершено\n"
+        f"👥 Сегмент: {title}\n"
+        f"🎁 Получили по {amount} монет: {count} пользователей\n"
+        f"⏱ Время: {time.perf_counter() - started:.2f} c"
+    )
+
 def process_bonus_add(message, amount):
     try:
         user_id = int(message.text)
@@ -683,19 +952,8 @@ def callback_resend(call):
         prizes = manager.get_all_prizes()
         for prize_id, img_name, used, price in prizes:
             if not used:
-                hide_img(img_name)
-                users = manager.get_users()
-                for user in users:
-                    try:
-                        with open(f'hidden_img/{img_name}', 'rb') as photo:
-                            bot.send_photo(
-                                user,
-                                photo,
-                                caption=f"🔄 ПОВТОРНАЯ ОТПРАВКА\nПриз #{prize_id}",
-                                reply_markup=gen_markup(prize_id)
-                            )
-                    except:
-                        pass
+                refresh_hidden_img(img_name)
+                resend_prize(prize_id, img_name)
         bot.answer_callback_query(call.id, "✅ Все призы повторно отправлены!")
     elif action == "resend_select":
         bot.send_message(call.from_user.id, "Введите ID приза для повторной отправки:")
@@ -708,53 +966,58 @@ def process_resend_select(message):
         img_name = manager.get_prize_img(prize_id)
         
         if img_name:
-            hide_img(img_name)
-            users = manager.get_users()
-            for user in users:
-                try:
-                    with open(f'hidden_img/{img_name}', 'rb') as photo:
-                        bot.send_photo(
-                            user,
-                            photo,
-                            caption=f"🔄 ПОВТОРНАЯ ОТПРАВКА\nПриз #{prize_id}",
-                            reply_markup=gen_markup(prize_id)
-                        )
-                except:
-                    pass
-            bot.reply_to(message, f"✅ Приз #{prize_id} повторно отправлен {len(users)} пользователям")
+            refresh_hidden_img(img_name)
+            stats = resend_prize(prize_id, img_name)
+            bot.reply_to(message, f"✅ Приз #{prize_id} повторно отправлен {stats.delivered} пользователям\n\n{stats.report()}")
         else:
             bot.reply_to(message, "❌ Приз не найден")
     except:
         bot.reply_to(message, "❌ Ошибка. Введите корректный ID приза")
 
 def polling_thread():
+    bot.remove_webhook()
     bot.polling(none_stop=True)
 
+def start_webhook():
+    server = WebhookServer(bot.dispatcher, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET or None)
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                        max_connections=bot.dispatcher.workers)
+    server.start()
+    print(f"🌐 Вебхук слушает {WEBHOOK_HOST}:{server.port}{WEBHOOK_PATH}")
+    return server
+
 if __name__ == '__main__':
+    manager.create_tables()
+    manager.warm_users()
+    
     if not os.path.exists('img'):
         os.makedirs('img')
     if not os.path.exists('hidden_img'):
         os.makedirs('hidden_img')
     
-    prizes_img = os.listdir('img')
-    if prizes_img:
-        existing_prizes = [x[1] for x in manager.get_all_prizes()] if manager.get_all_prizes() else []
-        for img in prizes_img:
-            if img not in existing_prizes:
-                manager.add_prize(img, None, 50)
-            hidden_path = f'hidden_img/{img}'
-            if not os.path.exists(hidden_path):
-                hide_img(img)
+    print(import_prizes(manager, 'img').report())
+    
+    threading.Thread(target=warm_hidden_images, daemon=True).start()
     
     admin_id = input("Введите ваш Telegram ID для назначения администратором: ")
     if admin_id.isdigit():
         manager.add_admin(int(admin_id))
         print(f"✅ Пользователь {admin_id} назначен администратором")
     
-    polling_thread = threading.Thread(target=polling_thread)
-    polling_schedule = threading.Thread(target=shedule_thread)
+    outbox_worker.start()
+    drop_scheduler = IntervalScheduler(manager, 'send_message', send_message, 'send_interval_hours')
+    bonus_scheduler = DailyScheduler(manager, 'second_chance', send_second_chance, 'bonus_time_hour')
+    ledger_scheduler = IntervalScheduler(manager, 'reconcile_ledger', ledger.run, 'reconcile_interval_hours')
     
-    polling_thread.start()
-    polling_schedule.start()
+    if '--webhook' in sys.argv:
+        start_webhook()
+    else:
+        polling_thread = threading.Thread(target=polling_thread)
+        polling_thread.start()
+    drop_scheduler.start()
+    bonus_scheduler.start()
+    ledger_scheduler.start()
     
     print("🤖 Бот запущен!")
\ No newline at end of file
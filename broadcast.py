@@ -0,0 +1,189 @@
+import requests
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from telebot.apihelper import ApiTelegramException
+
+ERROR_TITLES = {
+    'blocked': "заблокировали бота",
+    'not_found': "чат не найден",
+    'rate_limit': "лимит 429",
+    'network': "сеть",
+    'other': "прочие",
+}
+
+
+def classify_error(e):
+    if isinstance(e, ApiTelegramException):
+        description = (e.description or '').lower()
+        if e.error_code == 403:
+            return 'blocked'
+        if e.error_code == 400 and ('chat not found' in description or 'user not found' in description
+                                    or 'peer_id_invalid' in description):
+            return 'not_found'
+        if e.error_code == 429:
+            return 'rate_limit'
+        if e.error_code >= 500:
+            return 'network'
+        return 'other'
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return 'network'
+    return 'other'
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class BroadcastStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+        self.delivered = 0
+        self.failed = 0
+        self.messages = 0
+        self.retries = 0
+        self.latencies = []
+        self.errors = Counter()
+        self.started = time.monotonic()
+        self.finished = None
+
+    def record(self, latency):
+        with self.lock:
+            self.messages += 1
+            self.latencies.append(latency)
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self):
+        return self.messages / self.elapsed if self.elapsed > 0 else 0
+
+    def percentile(self, q):
+        if not self.latencies:
+            return 0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    def error_summary(self):
+        if not self.errors:
+            return ""
+        return " (" + ", ".join(f"{ERROR_TITLES[kind]}: {count}" for kind, count in self.errors.most_common()) + ")"
+
+    def report(self):
+        return (f"👥 Получателей: {self.users}\n"
+                f"✅ Доставлено: {self.delivered}\n"
+                f"❌ Ошибок: {self.failed}{self.error_summary()}\n"
+                f"🔁 Повторов после 429: {self.retries}\n"
+                f"⏱ Время: {self.elapsed:.1f} c\n"
+                f"📨 Скорость: {self.rate:.1f} сообщ./c\n"
+                f"📈 Задержка p50/p99: {self.percentile(0.5) * 1000:.0f}/{self.percentile(0.99) * 1000:.0f} мс")
+
+
+class Broadcaster:
+    def __init__(self, workers=16, global_rate=30, chat_rate=1, max_retries=3):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='broadcast')
+        self.chat_interval = 1 / chat_rate
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(global_rate)
+        self.lock = threading.Lock()
+        self.chat_next = {}
+        self.paused_until = 0
+        self._local = threading.local()
+
+    def _wait(self, chat_id):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.paused_until, self.chat_next.get(chat_id, 0))
+            self.chat_next[chat_id] = start + self.chat_interval
+        if start > now:
+            time.sleep(start - now)
+        self.bucket.acquire()
+
+    def _pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _prune(self):
+        with self.lock:
+            now = time.monotonic()
+            self.chat_next = {k: v for k, v in self.chat_next.items() if v > now}
+
+    def _rewind(self, args, kwargs):
+        for value in list(args) + list(kwargs.values()):
+            if hasattr(value, 'seek'):
+                value.seek(0)
+
+    def send(self, chat_id, method, *args, **kwargs):
+        stats = getattr(self._local, 'stats', None)
+        attempt = 0
+        while True:
+            if attempt:
+                self._rewind(args, kwargs)
+            self._wait(chat_id)
+            started = time.monotonic()
+            try:
+                result = method(chat_id, *args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                self._pause(retry_after)
+                if stats:
+                    with stats.lock:
+                        stats.retries += 1
+                continue
+            if stats:
+                stats.record(time.monotonic() - started)
+            return result
+
+    def broadcast(self, users, job, on_error=None, stats=None):
+        stats = stats or BroadcastStats()
+        stats.users += len(users)
+
+        def run(user):
+            self._local.stats = stats
+            try:
+                job(user)
+            except Exception as e:
+                with stats.lock:
+                    stats.failed += 1
+                    stats.errors[classify_error(e)] += 1
+                if on_error:
+                    on_error(user, e)
+            else:
+                with stats.lock:
+                    stats.delivered += 1
+            finally:
+                self._local.stats = None
+
+        list(self.executor.map(run, users))
+
+        stats.finish()
+        self._prune()
+        return stats
@@ -0,0 +1,95 @@
+import os
+import threading
+from collections import OrderedDict
+import cv2
+
+
+class CatalogService:
+    def __init__(self, manager, render, page_size=5, max_pages=64, thumb_size=320, max_thumbs=256, quality=85):
+        self.manager = manager
+        self.render = render
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.thumb_size = thumb_size
+        self.max_thumbs = max_thumbs
+        self.quality = quality
+        self.lock = threading.Lock()
+        self.pages = OrderedDict()
+        self.thumbs = OrderedDict()
+        self.thumb_ids = {}
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _lru_get(self, cache, key):
+        with self.lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    def _lru_put(self, cache, key, value, limit):
+        with self.lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > limit:
+                cache.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.pages.clear()
+            self.version += 1
+
+    def page(self, cursor=None, backward=False):
+        key = (cursor, backward)
+        page = self._lru_get(self.pages, key)
+        if page is not None:
+            self.hits += 1
+            return page
+        self.misses += 1
+
+        version = self.version
+        rows, has_prev, has_next = self.manager.get_shop_page(cursor, backward, self.page_size)
+        page = self.render(rows, has_prev, has_next) if rows else (None, None)
+        if version == self.version:
+            self._lru_put(self.pages, key, page, self.max_pages)
+        return page
+
+    def thumbnail(self, prize_id, user_id):
+        if not self.manager.is_prize_available(user_id, prize_id):
+            return None, None
+        image = self.manager.get_prize_img(prize_id)
+        if not image:
+            return None, None
+        path = f'img/{image}'
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None, None
+        key = (path, mtime)
+        thumb = self._lru_get(self.thumbs, key)
+        if thumb is None:
+            picture = cv2.imread(path)
+            if picture is None:
+                return None, None
+            height, width = picture.shape[:2]
+            scale = min(1.0, self.thumb_size / max(height, width))
+            if scale < 1:
+                picture = cv2.resize(picture, (max(1, int(width * scale)), max(1, int(height * scale))),
+                                     interpolation=cv2.INTER_AREA)
+            ok, encoded = cv2.imencode('.jpg', picture, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if not ok:
+                return None, None
+            thumb = encoded.tobytes()
+            self._lru_put(self.thumbs, key, thumb, self.max_thumbs)
+        return key, thumb
+
+    def get_thumb_file_id(self, key):
+        return self.thumb_ids.get(key)
+
+    def set_thumb_file_id(self, key, file_id):
+        self.thumb_ids[key] = file_id
+
+    def report(self):
+        return (f"🛒 Кэш магазина: страниц {len(self.pages)}, миниатюр {len(self.thumbs)}, "
+                f"попаданий {self.hits}, промахов {self.misses}")
@@ -0,0 +1,127 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from logic import build_collage, collage_cell_size, image_pool
+
+
+class Collage:
+    def __init__(self, jpeg, prize_count, total):
+        self.jpeg = jpeg
+        self.prize_count = prize_count
+        self.total = total
+
+
+class CollageService:
+    def __init__(self, manager, tile_size=200, max_size=4096, max_tiles=512, max_collages=128, quality=85, workers=2):
+        self.manager = manager
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='collage')
+        self.tile_size = tile_size
+        self.max_size = max_size
+        self.max_tiles = max_tiles
+        self.max_collages = max_collages
+        self.quality = quality
+        self.lock = threading.Lock()
+        self.tiles = OrderedDict()
+        self.collages = OrderedDict()
+        self.catalog = None
+        self.hits = 0
+        self.misses = 0
+
+    def _lru_get(self, cache, key):
+        with self.lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    def _lru_put(self, cache, key, value, limit):
+        with self.lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > limit:
+                cache.popitem(last=False)
+
+    def get_catalog(self):
+        catalog = self.catalog
+        if catalog is None:
+            catalog = tuple(sorted(os.listdir('img')))
+            self.catalog = catalog
+        return catalog
+
+    def invalidate_catalog(self):
+        self.catalog = None
+        self.executor.submit(self.warm)
+
+    def _cell_size(self, catalog):
+        return collage_cell_size(len(catalog), (self.tile_size, self.tile_size), self.max_size)
+
+    def _tile_limit(self):
+        return max(self.max_tiles, 2 * len(self.catalog or ()))
+
+    def warm(self):
+        catalog = self.get_catalog()
+        if not catalog:
+            return 0
+        size = self._cell_size(catalog)
+        paths = [f'{folder}/{img}' for img in catalog for folder in ('img', 'hidden_img')]
+        return sum(tile is not None for tile in image_pool.map(lambda path: self._tile(path, size), paths))
+
+    def _tile(self, path, size):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        key = (path, mtime, size)
+        tile = self._lru_get(self.tiles, key)
+        if tile is None:
+            image = cv2.imread(path)
+            if image is None:
+                print(f"Ошибка загрузки: {path}")
+                return None
+            tile = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+            self._lru_put(self.tiles, key, tile, self._tile_limit())
+        return tile
+
+    def render(self, user_id):
+        won = frozenset(x[0] for x in self.manager.get_winners_img(user_id))
+        catalog = self.get_catalog()
+        key = (won, catalog)
+
+        collage = self._lru_get(self.collages, key)
+        if collage is not None:
+            self.hits += 1
+            return collage
+        self.misses += 1
+
+        paths = [f'img/{img}' if img in won else f'hidden_img/{img}' for img in catalog]
+        if not paths:
+            return None
+        size = self._cell_size(catalog)
+        tiles = image_pool.imap(lambda path: self._tile(path, size), paths)
+
+        image = build_collage(tiles, len(paths), size, self.max_size)
+        if image is None:
+            return None
+
+        ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            return None
+
+        collage = Collage(encoded.tobytes(), len(won), len(catalog))
+        self._lru_put(self.collages, key, collage, self.max_collages)
+        return collage
+
+    def render_async(self, user_id, callback):
+        def done(future):
+            try:
+                collage, error = future.result(), None
+            except Exception as e:
+                collage, error = None, e
+            try:
+                callback(collage, error)
+            except Exception as e:
+                print(f"Ошибка отправки коллажа пользователю {user_id}: {e}")
+
+        self.executor.submit(self.render, user_id).add_done_callback(done)
@@ -9,5 +9,40 @@ DEFAULT_SETTINGS = {
     'coins_per_win': 10,
     'bonus_time_enabled': True,
     'bonus_time_hour': 22,
-    'failed_prize_discount': 40
-}
\ No newline at end of file
+    'failed_prize_discount': 40,
+    'bonus_time_discount': 20,
+    'reconcile_interval_hours': 24
+}
+
+BROADCAST_WORKERS = 16
+BROADCAST_GLOBAL_RATE = 30
+BROADCAST_CHAT_RATE = 1
+
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_MAX_ATTEMPTS = 3
+OUTBOX_RETRY_SECONDS = 60
+OUTBOX_KEEP_DROPS = 5
+INACTIVE_AFTER_FAILURES = 3
+
+PAGE_SIZE = 5
+
+LEDGER_ARCHIVE = 'ledger_archive.db'
+LEDGER_ARCHIVE_DAYS = 30
+LEDGER_CHUNK_SIZE = 5000
+
+BONUS_ACTIVE_DAYS = 7
+BONUS_TOP_USERS = 10
+
+DISPATCH_LANES = {
+    'prize': 4,
+    'default': 8,
+    'heavy': 2
+}
+
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_URL = ''
+WEBHOOK_SECRET = ''
+
+TELEGRAM_API_URL = None
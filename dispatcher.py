@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from telebot import TeleBot
+
+
+def update_chat_id(update):
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message:
+            return message.chat.id
+    call = update.callback_query
+    if call:
+        return call.message.chat.id if call.message else call.from_user.id
+    for name in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query',
+                 'poll_answer', 'my_chat_member', 'chat_member', 'chat_join_request'):
+        item = getattr(update, name, None)
+        if item is None:
+            continue
+        if getattr(item, 'chat', None):
+            return item.chat.id
+        user = getattr(item, 'from_user', None) or getattr(item, 'user', None)
+        if user:
+            return user.id
+    return ('update', update.update_id)
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class Lane:
+    def __init__(self, name, workers, samples=1000):
+        self.name = name
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"dispatch-{name}")
+        self.pending = {}
+        self.depth = 0
+        self.max_depth = 0
+        self.submitted = 0
+        self.processed = 0
+        self.errors = 0
+        self.waits = deque(maxlen=samples)
+        self.durations = deque(maxlen=samples)
+
+
+class UpdateDispatcher:
+    def __init__(self, handler, lanes=None, classify=None):
+        self.handler = handler
+        self.classify = classify or (lambda update: 'default')
+        self.lanes = {name: Lane(name, workers) for name, workers in (lanes or {'default': 8}).items()}
+        self.lock = threading.Lock()
+
+    def submit(self, update):
+        lane = self.lanes.get(self.classify(update)) or self.lanes['default']
+        key = update_chat_id(update)
+        with self.lock:
+            lane.submitted += 1
+            lane.depth += 1
+            lane.max_depth = max(lane.max_depth, lane.depth)
+            queue = lane.pending.get(key)
+            if queue is not None:
+                queue.append((update, time.monotonic()))
+                return
+            lane.pending[key] = deque([(update, time.monotonic())])
+        lane.pool.submit(self._drain, lane, key)
+
+    def _drain(self, lane, key):
+        while True:
+            with self.lock:
+                queue = lane.pending[key]
+                if not queue:
+                    del lane.pending[key]
+                    return
+                update, queued = queue.popleft()
+                lane.depth -= 1
+            started = time.monotonic()
+            failed = False
+            try:
+                self.handler(update)
+            except Exception as e:
+                print(f"❌ Ошибка обработки обновления {update.update_id}: {e}")
+                failed = True
+            with self.lock:
+                lane.processed += 1
+                lane.errors += failed
+                lane.waits.append(started - queued)
+                lane.durations.append(time.monotonic() - started)
+
+    @property
+    def workers(self):
+        return sum(lane.pool._max_workers for lane in self.lanes.values())
+
+    def depth(self):
+        with self.lock:
+            return sum(lane.depth for lane in self.lanes.values())
+
+    def report(self):
+        lines = ["🚦 Очереди обработки:"]
+        with self.lock:
+            for lane in self.lanes.values():
+                waits = list(lane.waits)
+                durations = list(lane.durations)
+                lines.append(f"• {lane.name}: в очереди {lane.depth} (макс. {lane.max_depth}), "
+                             f"обработано {lane.processed}, ошибок {lane.errors}, "
+                             f"ожидание p50/p99 {percentile(waits, 0.5) * 1000:.0f}/{percentile(waits, 0.99) * 1000:.0f} мс, "
+                             f"обработка p50/p99 {percentile(durations, 0.5) * 1000:.0f}/{percentile(durations, 0.99) * 1000:.0f} мс")
+        return "\n".join(lines)
+
+    def shutdown(self):
+        for lane in self.lanes.values():
+            lane.pool.shutdown(wait=True)
+
+
+class DispatchingTeleBot(TeleBot):
+    dispatcher = None
+
+    def process_new_updates(self, updates):
+        if self.dispatcher is None:
+            return super().process_new_updates(updates)
+        for update in updates:
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            self.dispatcher.submit(update)
+
+    def handle_update(self, update):
+        super().process_new_updates([update])
@@ -0,0 +1,109 @@
+import atexit
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from logic import CLAIM_WON, CLAIM_DUPLICATE, CLAIM_SOLD_OUT
+
+
+class ActiveDrop:
+    def __init__(self, prize_id, max_winners, owners=()):
+        self.prize_id = prize_id
+        self.max_winners = max_winners
+        self.owners = {user_id for user_id, _ in owners}
+        self.winners = {user_id for user_id, win_type in owners if win_type == 'regular'}
+        self.lock = threading.Lock()
+
+    @property
+    def remaining(self):
+        return max(0, self.max_winners - len(self.winners))
+
+
+class DropRegistry:
+    def __init__(self, manager, max_drops=50, batch_size=500, retry_delay=1):
+        self.manager = manager
+        self.max_drops = max_drops
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.drops = OrderedDict()
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.flush_lock = threading.Lock()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        atexit.register(self.flush)
+
+    def _remember(self, drop):
+        self.drops[drop.prize_id] = drop
+        self.drops.move_to_end(drop.prize_id)
+        while len(self.drops) > self.max_drops:
+            self.drops.popitem(last=False)
+
+    def start(self, prize_id, max_winners):
+        drop = ActiveDrop(prize_id, max_winners, self.manager.get_prize_owners(prize_id))
+        with self.lock:
+            self._remember(drop)
+        return drop
+
+    def get(self, prize_id, max_winners):
+        drop = self.drops.get(prize_id)
+        if drop is None:
+            with self.lock:
+                drop = self.drops.get(prize_id)
+                if drop is None:
+                    drop = ActiveDrop(prize_id, max_winners, self.manager.get_prize_owners(prize_id))
+                    self._remember(drop)
+        drop.max_winners = max_winners
+        return drop
+
+    def claim(self, user_id, prize_id, max_winners, coins=10):
+        drop = self.get(prize_id, max_winners)
+        if len(drop.winners) >= drop.max_winners:
+            return CLAIM_SOLD_OUT, 0
+
+        with drop.lock:
+            if len(drop.winners) >= drop.max_winners:
+                return CLAIM_SOLD_OUT, 0
+            if user_id in drop.owners:
+                return CLAIM_DUPLICATE, drop.remaining
+            drop.owners.add(user_id)
+            drop.winners.add(user_id)
+            remaining = drop.remaining
+
+        win_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.pending.put((user_id, prize_id, drop.max_winners, coins, win_time))
+        return CLAIM_WON, remaining
+
+    def _drain(self, first=None):
+        batch = [first] if first else []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            self.manager.add_winners_batch(batch)
+        except Exception as e:
+            print(f"Ошибка сохранения победителей: {e}")
+            for item in batch:
+                self.pending.put(item)
+            return False
+        return True
+
+    def _flush_loop(self):
+        while True:
+            first = self.pending.get()
+            with self.flush_lock:
+                if not self._write(self._drain(first)):
+                    time.sleep(self.retry_delay)
+
+    def flush(self):
+        with self.flush_lock:
+            batch = self._drain()
+            while batch:
+                if not self._write(batch):
+                    break
+                batch = self._drain()
@@ -0,0 +1,65 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+class ReconcileReport:
+    def __init__(self):
+        self.actions = 0
+        self.users = 0
+        self.flagged = 0
+        self.archived = 0
+        self.started = time.monotonic()
+        self.elapsed = 0
+        self.finished_at = None
+
+    def report(self):
+        return (f"📒 Сверка журнала ({self.finished_at:%Y-%m-%d %H:%M}):\n"
+                f"🧾 Новых записей: {self.actions}\n"
+                f"👥 Проверено пользователей: {self.users}\n"
+                f"⚠️ Расхождений: {self.flagged}\n"
+                f"🗄 В архив: {self.archived}\n"
+                f"⏱ Время: {self.elapsed:.1f} c")
+
+
+class LedgerReconciler:
+    def __init__(self, manager, archive_path='ledger_archive.db', archive_days=30, chunk_size=5000):
+        self.manager = manager
+        self.archive_path = archive_path
+        self.archive_days = archive_days
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.last = None
+
+    def run(self):
+        with self.lock:
+            result = ReconcileReport()
+            while True:
+                count = self.manager.apply_ledger_chunk(self.chunk_size)
+                result.actions += count
+                if count < self.chunk_size:
+                    break
+
+            after = 0
+            while True:
+                count, after, flagged = self.manager.reconcile_users(after, self.chunk_size)
+                result.users += count
+                result.flagged += flagged
+                if count < self.chunk_size:
+                    break
+
+            if self.archive_days:
+                before = (datetime.now() - timedelta(days=self.archive_days)).strftime('%Y-%m-%d %H:%M:%S')
+                result.archived = self.manager.archive_ledger(self.archive_path, before, self.chunk_size)
+
+            result.elapsed = time.monotonic() - result.started
+            result.finished_at = datetime.now()
+            self.last = result
+            print(result.report())
+            return result
+
+    def history(self, user_id, limit=20):
+        return self.manager.get_ledger_history(user_id, limit, self.archive_path)
+
+    def report(self):
+        return self.last.report() if self.last else "📒 Сверка журнала еще не выполнялась"
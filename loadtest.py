@@ -0,0 +1,542 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SEND_METHODS = {'sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText'}
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeTelegramAPI:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.lock = threading.Condition()
+        self.updates = deque()
+        self.expected = defaultdict(deque)
+        self.latencies = []
+        self.calls = defaultdict(int)
+        self.message_id = 0
+        self.server = FakeServer((host, port), self._handler_class())
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push(self, update):
+        with self.lock:
+            self.updates.append(update)
+            self.lock.notify_all()
+
+    def expect(self, chat_id):
+        with self.lock:
+            self.expected[chat_id].append(time.monotonic())
+
+    def wait(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while len(self.latencies) < count:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self.lock.wait(left)
+        return True
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + min(float(params.get('timeout') or 0), 1)
+        with self.lock:
+            while self.updates and self.updates[0]['update_id'] < offset:
+                self.updates.popleft()
+            while not self.updates and time.monotonic() < deadline:
+                self.lock.wait(deadline - time.monotonic())
+            return list(self.updates)[:100]
+
+    def _sent(self, method, params):
+        chat_id = int(params.get('chat_id') or 0)
+        with self.lock:
+            self.message_id += 1
+            message = {'message_id': self.message_id, 'date': int(time.time()),
+                       'chat': {'id': chat_id, 'type': 'private'}, 'text': ''}
+            if method == 'sendPhoto':
+                message['photo'] = [{'file_id': f"fake{self.message_id}", 'file_unique_id': f"u{self.message_id}",
+                                     'width': 1, 'height': 1}]
+            if self.expected[chat_id]:
+                self.latencies.append(time.monotonic() - self.expected[chat_id].popleft())
+                self.lock.notify_all()
+        return message
+
+    def call(self, method, params):
+        with self.lock:
+            self.calls[method] += 1
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'fake', 'username': 'fake_bot'}
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method in SEND_METHODS:
+            return self._sent(method, params)
+        return True
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                url = urlparse(self.path)
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                content_type = self.headers.get('Content-Type') or ''
+                if content_type.startswith('application/x-www-form-urlencoded'):
+                    params.update({k: v[-1] for k, v in parse_qs(body.decode('utf-8')).items()})
+                elif content_type.startswith('application/json') and body:
+                    params.update(json.loads(body))
+                result = api.call(url.path.rsplit('/', 1)[-1], params)
+                data = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def make_update(update_id, chat_id, text):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time.time()),
+                        'chat': {'id': chat_id, 'type': 'private'},
+                        'from': {'id': chat_id, 'is_bot': False, 'first_name': f"load{chat_id}"},
+                        'text': text}}
+
+
+def post_update(url, update):
+    request = urllib.request.Request(url, json.dumps(update).encode('utf-8'), {'Content-Type': 'application/json'})
+    urllib.request.urlopen(request).read()
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+@contextmanager
+def workspace():
+    root = tempfile.mkdtemp(prefix='loadtest-')
+    cwd = os.getcwd()
+    os.chdir(root)
+    for folder in ('img', 'hidden_img'):
+        os.makedirs(folder)
+    try:
+        yield root
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def make_manager(name, manager_class=None):
+    if manager_class is None:
+        from logic import DatabaseManager
+        manager_class = DatabaseManager
+    manager = manager_class(os.path.abspath(name))
+    manager.create_tables()
+    return manager
+
+
+def seed_users(manager, count, coins=False):
+    with manager.transaction() as conn:
+        conn.execute(f"""WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+                         INSERT INTO users (user_id, user_name, coins)
+                         SELECT i, 'load' || i, {'abs(random()) % 1000' if coins else '0'} FROM n""", (count,))
+
+
+def report_checks(checks):
+    for title, ok in checks.items():
+        print(f"{'✅' if ok else '❌'} {title}")
+    return all(checks.values())
+
+
+def time_calls(calls, repeat):
+    for name, call in calls:
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - started)
+        print(f"{name:<32} p50 {percentile(timings, 0.5) * 1000:8.3f} мс   p99 {percentile(timings, 0.99) * 1000:8.3f} мс")
+
+
+def run_threads(target, batches):
+    pool = [threading.Thread(target=target, args=(batch,)) for batch in batches]
+    started = time.monotonic()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return time.monotonic() - started
+
+
+def run(mode, count, chats, command, timeout):
+    api = FakeTelegramAPI()
+    api.start()
+
+    import config
+    config.API_TOKEN = '123:fake'
+    config.TELEGRAM_API_URL = api.url
+    config.DATABASE = os.path.abspath('loadtest.db')
+    config.WEBHOOK_HOST = '127.0.0.1'
+    config.WEBHOOK_PORT = 0
+    config.WEBHOOK_URL = ''
+    import bot
+
+    bot.manager.create_tables()
+    bot.manager.warm_users()
+
+    if mode == 'webhook':
+        server = bot.start_webhook()
+        url = f"http://127.0.0.1:{server.port}{config.WEBHOOK_PATH}"
+        deliver = lambda update: post_update(url, update)
+    else:
+        threading.Thread(target=bot.bot.polling, kwargs={'none_stop': True, 'interval': 0, 'timeout': 1},
+                         daemon=True).start()
+        deliver = api.push
+
+    started = time.monotonic()
+    for i in range(count):
+        chat_id = 1000 + i % chats
+        api.expect(chat_id)
+        deliver(make_update(i + 1, chat_id, command))
+    completed = api.wait(count, timeout)
+    elapsed = time.monotonic() - started
+
+    if mode == 'webhook':
+        server.stop()
+    else:
+        bot.bot.stop_polling()
+    api.stop()
+
+    print(f"Режим: {mode}")
+    print(f"Обновлений: {len(api.latencies)}/{count} ({chats} чатов, {command})" + ("" if completed else " — таймаут"))
+    print(f"Время: {elapsed:.2f} c")
+    print(f"Пропускная способность: {len(api.latencies) / elapsed:.1f} обновл./c")
+    print(f"Задержка p50/p99: {percentile(api.latencies, 0.5) * 1000:.0f}/{percentile(api.latencies, 0.99) * 1000:.0f} мс")
+
+
+def run_purchases(count, threads, prizes=50, coins=1000):
+    manager = make_manager('purchases.db')
+    manager.add_user(1, 'stress')
+    manager.add_coins(1, coins)
+    for i in range(prizes):
+        manager.add_prize(f"stress{i}.png", price=random.choice([30, 50, 70]))
+
+    keys = [random.randrange(count // 2 or 1) for _ in range(count)]
+    requests = [(f"req:{key}", key % prizes + 1) for key in keys]
+    results = []
+    lock = threading.Lock()
+
+    def worker(batch):
+        for request_id, prize_id in batch:
+            success, message = manager.buy_prize(1, prize_id, request_id)
+            with lock:
+                results.append((request_id, success, message))
+
+    elapsed = run_threads(worker, [requests[i::threads] for i in range(threads)])
+
+    conn = manager.connect()
+    balance = manager.get_coins(1)
+    ledger = conn.execute('SELECT SUM(coins_change) FROM bonus_actions WHERE user_id = 1').fetchone()[0]
+    spent = -conn.execute("SELECT COALESCE(SUM(coins_change), 0) FROM bonus_actions WHERE user_id = 1 AND action_type = 'prize_purchase'").fetchone()[0]
+    owned = conn.execute("SELECT COUNT(*), COALESCE(SUM(p.price), 0) FROM winners w JOIN prizes p ON p.prize_id = w.prize_id WHERE w.user_id = 1").fetchone()
+    answers = defaultdict(set)
+    for request_id, success, message in results:
+        answers[request_id].add((success, message))
+    succeeded = sum(1 for values in answers.values() if any(success for success, _ in values))
+
+    print(f"Покупок: {len(results)} ({len(answers)} уникальных запросов, {threads} потоков) за {elapsed:.2f} c")
+    print(f"Куплено призов: {owned[0]}, баланс: {balance}, журнал: {ledger}")
+    return report_checks({
+        "баланс не отрицательный": balance >= 0,
+        "баланс совпадает с журналом": balance == ledger,
+        "списано столько, сколько стоят купленные призы": spent == owned[1],
+        "каждый приз куплен не больше одного раза": succeeded == owned[0],
+        "повторы запроса получают тот же ответ": all(len(values) == 1 for values in answers.values()),
+    })
+
+
+def run_claims(count, threads, max_winners=100, coins=10):
+    from datetime import datetime
+    from drops import DropRegistry
+    from logic import CLAIM_WON, CLAIM_SOLD_OUT
+    manager = make_manager('claims.db')
+    seed_users(manager, count + 100)
+    prize_id = manager.add_prize('claims.png')
+    drops = DropRegistry(manager)
+    drops.start(prize_id, max_winners)
+
+    latencies = []
+    results = defaultdict(int)
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def worker(users):
+        barrier.wait()
+        for user_id in users:
+            started = time.monotonic()
+            result, _ = drops.claim(user_id, prize_id, max_winners, coins)
+            elapsed = time.monotonic() - started
+            with lock:
+                latencies.append(elapsed)
+                results[result] += 1
+
+    users = list(range(1, count + 1))
+    elapsed = run_threads(worker, [users[i::threads] for i in range(threads)])
+    drops.flush()
+
+    win_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    manager.add_winners_batch([(user_id, prize_id, max_winners, coins, win_time) for user_id in range(count + 1, count + 11)])
+    conn = manager.connect()
+    winners = manager.get_winners_count(prize_id)
+    credited = conn.execute('SELECT COALESCE(SUM(coins), 0) FROM users').fetchone()[0]
+    restarted = DropRegistry(manager).claim(count + 100, prize_id, max_winners, coins)[0]
+
+    print(f"Нажатий: {len(latencies)} ({threads} потоков, лимит {max_winners}) за {elapsed:.2f} c")
+    print(f"Выиграли: {results[CLAIM_WON]}, опоздали: {results[CLAIM_SOLD_OUT]}, в базе: {winners}")
+    print(f"Задержка p50/p99: {percentile(latencies, 0.5) * 1e6:.0f}/{percentile(latencies, 0.99) * 1e6:.0f} мкс")
+    return report_checks({
+        "ровно max_winners победителей в базе": winners == max_winners,
+        "ровно max_winners успешных нажатий": results[CLAIM_WON] == max_winners,
+        "монеты начислены только победителям": credited == max_winners * coins,
+        "база не принимает победителей сверх лимита": manager.get_winners_count(prize_id) == max_winners,
+        "после перезапуска приз считается разыгранным": restarted == CLAIM_SOLD_OUT,
+    })
+
+
+def run_db(count, threads, users=1000):
+    import sqlite3
+    from logic import DatabaseManager
+
+    class UnpooledManager(DatabaseManager):
+        def connect(self):
+            return sqlite3.connect(self.database)
+
+    def bench(name, manager_class):
+        manager = make_manager(name, manager_class)
+        seed_users(manager, users)
+
+        def worker(ops):
+            for i in ops:
+                user_id = i % users + 1
+                if i % 10:
+                    manager.get_coins(user_id)
+                else:
+                    manager.add_coins(user_id, 1)
+
+        return count / run_threads(worker, [range(i, count, threads) for i in range(threads)])
+
+    before = bench('unpooled.db', UnpooledManager)
+    after = bench('pooled.db', DatabaseManager)
+    print(f"Операций: {count} (90% чтение, 10% запись, {threads} потоков)")
+    print(f"Новое соединение на операцию: {before:.0f} оп/c")
+    print(f"Пул соединений: {after:.0f} оп/c")
+    print(f"Ускорение: x{after / before:.1f}")
+
+
+def run_reads(rows, repeat=20, users=100000, per_prize=1000):
+    from logic import _migrate_user_stats
+    manager = make_manager('reads.db')
+    prizes = max(1, rows // per_prize)
+    started = time.monotonic()
+    seed_users(manager, users, coins=True)
+    with manager.transaction() as conn:
+        conn.execute("""WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+                        INSERT INTO prizes (prize_id, image, used, add_date, price)
+                        SELECT i, 'load' || i || '.png', i % 2, datetime('now'), 30 + i % 5 * 10 FROM n""", (prizes,))
+        conn.execute("""WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < :rows - 1)
+                        INSERT INTO winners (user_id, prize_id, win_time, win_type)
+                        SELECT i % :users + 1, i / :per_prize + 1, datetime('now'),
+                               CASE WHEN i % 10 THEN 'regular' ELSE 'purchase' END FROM n""",
+                     {'rows': rows, 'users': users, 'per_prize': per_prize})
+        conn.execute("""INSERT INTO failed_prizes (user_id, prize_id, fail_time)
+                        SELECT user_id, (prize_id % :prizes) + 1, datetime('now') FROM winners WHERE rowid % 10 = 0""",
+                     {'prizes': prizes})
+        _migrate_user_stats(conn)
+    conn.execute('ANALYZE')
+    print(f"Заполнено: {rows} победителей, {users} пользователей, {prizes} призов за {time.monotonic() - started:.1f} c")
+
+    user_id, prize_id = users // 2, prizes // 2
+    reads = [
+        ('get_winners_count', lambda: manager.get_winners_count(prize_id)),
+        ('get_prize_owners', lambda: manager.get_prize_owners(prize_id)),
+        ('get_winners_img', lambda: manager.get_winners_img(user_id)),
+        ('get_coins', lambda: manager.get_coins(user_id)),
+        ('get_prize_img', lambda: manager.get_prize_img(prize_id)),
+        ('is_prize_available', lambda: manager.is_prize_available(user_id, prize_id)),
+        ('get_random_prize', manager.get_random_prize),
+        ('get_unused_prizes_count', manager.get_unused_prizes_count),
+        ('count_prizes', manager.count_prizes),
+        ('get_all_prizes', manager.get_all_prizes),
+        ('get_available_prizes', manager.get_available_prizes),
+        ('get_shop_page', manager.get_shop_page),
+        ('get_failed_prizes_page', lambda: manager.get_failed_prizes_page(user_id)),
+        ('get_all_users(10)', lambda: manager.get_all_users(10)),
+        ('get_users', manager.get_users),
+        ('count_active_users', manager.count_active_users),
+        ('get_second_chance_targets', manager.get_second_chance_targets),
+    ]
+    for board in ('prizes', 'purchases', 'coins', 'weekly'):
+        reads.append((f"get_rating('{board}')", lambda board=board: manager.get_rating(board)))
+        reads.append((f"get_user_rank('{board}')", lambda board=board: manager.get_user_rank(user_id, board)))
+    time_calls(reads, repeat)
+
+
+def make_images(count, folders):
+    import cv2
+    import numpy as np
+    for i in range(count):
+        height, width = random.randint(300, 900), random.randint(300, 900)
+        image = np.full((height, width, 3), random.sample(range(256), 3), dtype=np.uint8)
+        cv2.circle(image, (width // 2, height // 2), min(height, width) // 3, (255, 255, 255), -1)
+        for folder in folders:
+            cv2.imwrite(f'{folder}/prize{i}.jpg', image)
+
+
+def run_collage(sizes=(25, 100, 400), repeat=3):
+    import tracemalloc
+    import cv2
+    import numpy as np
+    from collage import CollageService
+    manager = make_manager('collage.db')
+
+    for count in sizes:
+        for folder in ('img', 'hidden_img'):
+            for name in os.listdir(folder):
+                os.remove(os.path.join(folder, name))
+        make_images(count, ('img', 'hidden_img'))
+
+        cold, cached = [], []
+        for _ in range(repeat):
+            service = CollageService(manager)
+            tracemalloc.start()
+            started = time.perf_counter()
+            collage = service.render(1)
+            cold.append(time.perf_counter() - started)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            service.collages.clear()
+            started = time.perf_counter()
+            service.render(1)
+            cached.append(time.perf_counter() - started)
+        image = cv2.imdecode(np.frombuffer(collage.jpeg, np.uint8), cv2.IMREAD_COLOR)
+        print(f"{count:>4} плиток: {image.shape[1]}x{image.shape[0]}, "
+              f"с декодированием {percentile(cold, 0.5) * 1000:.0f} мс, из кэша плиток {percentile(cached, 0.5) * 1000:.0f} мс, "
+              f"пик памяти {peak / 2 ** 20:.1f} МБ")
+
+
+def run_images(count):
+    import cv2
+    from logic import hide_img, image_pool
+    make_images(count, ('img',))
+    names = sorted(os.listdir('img'))
+
+    def tile(name):
+        return cv2.resize(cv2.imread(f'img/{name}'), (200, 200), interpolation=cv2.INTER_AREA)
+
+    print(f"Изображений: {count}, потоков в пуле: {image_pool.workers}")
+    for title, job in (("hide_img", hide_img), ("плитки коллажа", tile)):
+        started = time.perf_counter()
+        for name in names:
+            job(name)
+        serial = time.perf_counter() - started
+        started = time.perf_counter()
+        image_pool.map(job, names)
+        pooled = time.perf_counter() - started
+        print(f"{title}: последовательно {count / serial:.0f} изобр./c, в пуле {count / pooled:.0f} изобр./c, "
+              f"ускорение x{serial / pooled:.1f}")
+
+
+def run_users(users, repeat=20):
+    manager = make_manager('users.db')
+    started = time.monotonic()
+    seed_users(manager, users)
+    print(f"Пользователей: {users}, заполнено за {time.monotonic() - started:.1f} c")
+
+    started = time.perf_counter()
+    manager.warm_users()
+    print(f"{'warm_users':<32} {(time.perf_counter() - started) * 1000:10.3f} мс")
+
+    next_id = users + 1
+
+    def add_user():
+        nonlocal next_id
+        manager.add_user(next_id, f"load{next_id}")
+        next_id += 1
+
+    time_calls([
+        ('user_id in get_users()', lambda: random.randint(1, users) in manager.get_users()),
+        ('is_registered', lambda: manager.is_registered(random.randint(1, users))),
+        ('is_registered (нет в базе)', lambda: manager.is_registered(-1)),
+        ('len(get_users())', lambda: len(manager.get_users())),
+        ('count_users', manager.count_users),
+        ('count_active_users', manager.count_active_users),
+        ('add_user', add_user),
+    ], repeat)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['polling', 'webhook', 'both', 'purchases', 'claims', 'db', 'reads', 'collage', 'images', 'users'])
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--command', default='/coins')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    if args.mode == 'both':
+        for mode in ('polling', 'webhook'):
+            subprocess.run([sys.executable, __file__, mode, '--updates', str(args.updates), '--chats', str(args.chats),
+                            '--command', args.command, '--timeout', str(args.timeout)])
+            print()
+        sys.exit(0)
+
+    modes = {
+        'purchases': lambda: run_purchases(args.updates, args.threads),
+        'claims': lambda: run_claims(args.updates, args.threads),
+        'db': lambda: run_db(args.updates, args.threads),
+        'reads': lambda: run_reads(args.updates),
+        'collage': run_collage,
+        'images': lambda: run_images(args.updates),
+        'users': lambda: run_users(args.updates),
+    }
+    with workspace():
+        ok = modes.get(args.mode, lambda: run(args.mode, args.updates, args.chats, args.command, args.timeout))()
+    sys.exit(1 if ok is False else 0)
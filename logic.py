@@ -1,17 +1,272 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from config import DATABASE 
+from config import DATABASE, DEFAULT_SETTINGS
 import os
+import json
+import time
+import hashlib
+import sys
+import zipfile
+import tarfile
 import cv2
 import numpy as np
 from math import sqrt, ceil, floor
+from concurrent.futures import ThreadPoolExecutor
+
+CLAIM_WON = 1
+CLAIM_DUPLICATE = 0
+CLAIM_SOLD_OUT = -1
+
+WEEK_FORMAT = '%Y-W%W'
+
+PERMANENT_ERRORS = ('blocked', 'not_found')
+
+PRICE_SQL = '''p.price * (100 - CASE WHEN fp.user_id IS NULL THEN 0 ELSE :failed_discount END)
+               * (100 - CASE WHEN fp.user_id IS NULL THEN 0 ELSE :bonus_discount END) / 10000'''
+
+RATING_BOARDS = {
+    'prizes': ('''SELECT u.user_name, s.prizes FROM user_stats s JOIN users u ON s.user_id = u.user_id
+                  WHERE s.prizes > 0 ORDER BY s.prizes DESC LIMIT :limit''',
+               'SELECT prizes FROM user_stats WHERE user_id = :user_id',
+               'SELECT COUNT(*) FROM user_stats WHERE prizes > :value'),
+    'purchases': ('''SELECT u.user_name, s.purchases FROM user_stats s JOIN users u ON s.user_id = u.user_id
+                     WHERE s.purchases > 0 ORDER BY s.purchases DESC LIMIT :limit''',
+                  'SELECT purchases FROM user_stats WHERE user_id = :user_id',
+                  'SELECT COUNT(*) FROM user_stats WHERE purchases > :value'),
+    'coins': ('SELECT user_name, coins FROM users ORDER BY coins DESC LIMIT :limit',
+              'SELECT coins FROM users WHERE user_id = :user_id',
+              'SELECT COUNT(*) FROM users WHERE coins > :value'),
+    'weekly': ('''SELECT u.user_name, s.prizes FROM user_weekly_stats s JOIN users u ON s.user_id = u.user_id
+                  WHERE s.week = :week ORDER BY s.prizes DESC LIMIT :limit''',
+               'SELECT prizes FROM user_weekly_stats WHERE week = :week AND user_id = :user_id',
+               'SELECT COUNT(*) FROM user_weekly_stats WHERE week = :week AND prizes > :value'),
+}
+
+def _add_column(conn, table, column, definition):
+    columns = [x[1] for x in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def _migrate_legacy_columns(conn):
+    _add_column(conn, 'users', 'coins', 'INTEGER DEFAULT 0')
+    _add_column(conn, 'users', 'registration_date', 'TEXT')
+    _add_column(conn, 'prizes', 'added_by', 'INTEGER')
+    _add_column(conn, 'prizes', 'add_date', 'TEXT')
+    _add_column(conn, 'prizes', 'price', 'INTEGER DEFAULT 50')
+    _add_column(conn, 'winners', 'win_type', "TEXT DEFAULT 'regular'")
+
+def _migrate_indexes(conn):
+    conn.execute('''
+    DELETE FROM winners WHERE rowid NOT IN (
+        SELECT MIN(rowid) FROM winners GROUP BY user_id, prize_id
+    )
+    ''')
+    conn.execute('''
+    DELETE FROM failed_prizes WHERE fail_id NOT IN (
+        SELECT MIN(fail_id) FROM failed_prizes GROUP BY user_id, prize_id
+    )
+    ''')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_winners_user_prize ON winners(user_id, prize_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_winners_prize ON winners(prize_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_winners_type_user ON winners(win_type, user_id)')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_failed_prizes_user_prize ON failed_prizes(user_id, prize_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bonus_actions_user ON bonus_actions(user_id, action_time)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_prizes_used_price ON prizes(used, price)')
+
+def _migrate_scheduled_jobs(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS scheduled_jobs (
+        job_name TEXT PRIMARY KEY,
+        next_run TEXT,
+        last_run TEXT
+    )
+    ''')
+
+def _migrate_prize_hashes(conn):
+    _add_column(conn, 'prizes', 'content_hash', 'TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_prizes_content_hash ON prizes(content_hash)')
+
+def _migrate_user_stats(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id INTEGER PRIMARY KEY,
+        prizes INTEGER DEFAULT 0,
+        purchases INTEGER DEFAULT 0,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS user_weekly_stats (
+        week TEXT,
+        user_id INTEGER,
+        prizes INTEGER DEFAULT 0,
+        PRIMARY KEY(week, user_id)
+    )
+    ''')
+    conn.execute('''
+    INSERT OR REPLACE INTO user_stats (user_id, prizes, purchases)
+    SELECT user_id, SUM(win_type = 'regular'), SUM(win_type = 'purchase') FROM winners GROUP BY user_id
+    ''')
+    conn.execute(f'''
+    INSERT OR REPLACE INTO user_weekly_stats (week, user_id, prizes)
+    SELECT strftime('{WEEK_FORMAT}', win_time), user_id, COUNT(*) FROM winners 
+    WHERE win_type = 'regular' AND win_time IS NOT NULL GROUP BY 1, 2
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_stats_prizes ON user_stats(prizes DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_stats_purchases ON user_stats(purchases DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_weekly_stats_prizes ON user_weekly_stats(week, prizes DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_coins ON users(coins DESC)')
+
+def _migrate_outbox(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS outbox (
+        prize_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TEXT,
+        PRIMARY KEY(prize_id, user_id)
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(status, next_attempt_at)')
+
+def _migrate_user_activity(conn):
+    _add_column(conn, 'users', 'failures', 'INTEGER DEFAULT 0')
+    _add_column(conn, 'users', 'active', 'INTEGER DEFAULT 1')
+    _add_column(conn, 'outbox', 'error', 'TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_active ON users(active)')
+
+def _migrate_purchase_requests(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS purchase_requests (
+        request_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        prize_id INTEGER,
+        success INTEGER,
+        message TEXT,
+        request_time TEXT
+    )
+    ''')
+
+def _migrate_ledger_snapshots(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS ledger_snapshots (
+        user_id INTEGER PRIMARY KEY,
+        balance INTEGER DEFAULT 0,
+        last_action_id INTEGER DEFAULT 0,
+        checked_at TEXT,
+        discrepancy INTEGER DEFAULT 0
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ledger_snapshots_discrepancy ON ledger_snapshots(discrepancy) WHERE discrepancy != 0')
+
+def _migrate_last_seen(conn):
+    _add_column(conn, 'users', 'last_seen', 'TEXT')
+    conn.execute('''
+    UPDATE users SET last_seen = (SELECT MAX(win_time) FROM winners w WHERE w.user_id = users.user_id)
+    WHERE last_seen IS NULL
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen)')
+
+MIGRATIONS = [
+    (1, _migrate_legacy_columns),
+    (2, _migrate_indexes),
+    (3, _migrate_scheduled_jobs),
+    (4, _migrate_prize_hashes),
+    (5, _migrate_user_stats),
+    (6, _migrate_outbox),
+    (7, _migrate_user_activity),
+    (8, _migrate_purchase_requests),
+    (9, _migrate_ledger_snapshots),
+    (10, _migrate_last_seen),
+]
+
+class ConnectionPool:
+    def __init__(self, database, busy_timeout=5000, cached_statements=256):
+        self.database = database
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.lock = threading.Lock()
+        self.connections = {}
+        self._local = threading.local()
+
+    def _open(self):
+        conn = sqlite3.connect(self.database, timeout=self.busy_timeout / 1000,
+                               cached_statements=self.cached_statements, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA busy_timeout={self.busy_timeout}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+            with self.lock:
+                for thread, old in list(self.connections.values()):
+                    if not thread.is_alive():
+                        old.close()
+                        del self.connections[thread.ident]
+                self.connections[threading.get_ident()] = (threading.current_thread(), conn)
+        return conn
+
+    def close_all(self):
+        with self.lock:
+            for thread, conn in self.connections.values():
+                conn.close()
+            self.connections.clear()
+        self._local = threading.local()
 
 class DatabaseManager:
     def __init__(self, database):
         self.database = database
+        self.pool = ConnectionPool(database)
+        self.settings = None
+        self.settings_lock = threading.Lock()
+        self.subscribers = {}
+        self.user_ids = None
+        self.users_lock = threading.Lock()
+        self.seen = {}
+        self._transactions = threading.local()
+
+    def connect(self):
+        return self.pool.get()
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        depth = getattr(self._transactions, 'depth', 0)
+        savepoint = f'nested_{depth}'
+        if depth:
+            conn.execute(f'SAVEPOINT {savepoint}')
+        elif conn.in_transaction:
+            conn.rollback()
+            raise RuntimeError("На соединении осталась незавершенная транзакция, изменения отменены")
+        else:
+            conn.execute('BEGIN IMMEDIATE')
+        self._transactions.depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            if depth:
+                conn.execute(f'ROLLBACK TO {savepoint}')
+                conn.execute(f'RELEASE {savepoint}')
+            else:
+                conn.rollback()
+            raise
+        else:
+            if depth:
+                conn.execute(f'RELEASE {savepoint}')
+            else:
+                conn.commit()
+        finally:
+            self._transactions.depth = depth
 
     def create_tables(self):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -33,6 +288,15 @@ class DatabaseManager:
             )
             ''')
 
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS prize_files (
+                image TEXT,
+                hidden INTEGER DEFAULT 0,
+                file_id TEXT,
+                PRIMARY KEY(image, hidden)
+            )
+            ''')
+
             conn.execute('''
             CREATE TABLE IF NOT EXISTS winners (
                 user_id INTEGER,
@@ -73,137 +337,397 @@ class DatabaseManager:
             )
             ''')
 
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                applied_at TEXT
+            )
+            ''')
+
             conn.commit()
 
+        self.migrate()
+
+    def get_schema_version(self):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('SELECT MAX(version) FROM schema_version')
+        return cur.fetchone()[0] or 0
+
+    def migrate(self):
+        current = self.get_schema_version()
+        for version, migration in MIGRATIONS:
+            if version <= current:
+                continue
+            with self.transaction() as conn:
+                migration(conn)
+                conn.execute('INSERT INTO schema_version (version, applied_at) VALUES (?, ?)', 
+                            (version, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            print(f"Применена миграция базы данных #{version}")
+
     def add_user(self, user_id, user_name):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
-            conn.execute('INSERT OR IGNORE INTO users (user_id, user_name) VALUES (?, ?)', (user_id, user_name or str(user_id)))
+            cur = conn.execute('INSERT OR IGNORE INTO users (user_id, user_name, last_seen) VALUES (?, ?, ?)', 
+                               (user_id, user_name or str(user_id), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            if not cur.rowcount:
+                conn.execute('UPDATE users SET active = 1, failures = 0 WHERE user_id = ? AND active = 0', (user_id,))
             conn.commit()
+        if self.user_ids is not None:
+            self.user_ids.add(user_id)
+        return cur.rowcount > 0
+
+    def touch_user(self, user_id, every=3600):
+        now = time.monotonic()
+        if now - self.seen.get(user_id, -every) < every:
+            return
+        self.seen[user_id] = now
+        conn = self.connect()
+        with conn:
+            conn.execute('UPDATE users SET last_seen = ? WHERE user_id = ?', 
+                        (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id))
+
+    def warm_users(self):
+        with self.users_lock:
+            if self.user_ids is None:
+                conn = self.connect()
+                cur = conn.cursor()
+                cur.execute('SELECT user_id FROM users')
+                self.user_ids = {x[0] for x in cur}
+        return self.user_ids
+
+    def is_registered(self, user_id):
+        user_ids = self.user_ids
+        if user_ids is None:
+            user_ids = self.warm_users()
+        return user_id in user_ids
+
+    def count_users(self):
+        if self.user_ids is not None:
+            return len(self.user_ids)
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM users')
+        return cur.fetchone()[0]
+
+    def count_active_users(self):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM users WHERE active = 1')
+        return cur.fetchone()[0]
 
-    def add_prize(self, image_path, added_by=None, price=50):
+    def count_prizes(self):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM prizes')
+        return cur.fetchone()[0]
+
+    def add_prize(self, image_path, added_by=None, price=50, content_hash=None):
         add_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
-            cur.execute('''INSERT INTO prizes (image, added_by, add_date, price) VALUES (?, ?, ?, ?)''', 
-                       (image_path, added_by, add_date, price))
+            cur.execute('''INSERT INTO prizes (image, added_by, add_date, price, content_hash) VALUES (?, ?, ?, ?, ?)''', 
+                       (image_path, added_by, add_date, price, content_hash))
             conn.commit()
             return cur.lastrowid
 
-    def add_winner(self, user_id, prize_id, win_type='regular'):
-        win_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        conn = sqlite3.connect(self.database)
-        with conn:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM winners WHERE user_id = ? AND prize_id = ?", (user_id, prize_id))
-            if cur.fetchall():
-                return 0
-            else:
-                conn.execute('''INSERT INTO winners (user_id, prize_id, win_time, win_type) VALUES (?, ?, ?, ?)''', 
-                           (user_id, prize_id, win_time, win_type))
-                if win_type == 'regular':
-                    self.add_coins(user_id, 10)
-                conn.commit()
-                return 1
+    def add_prizes(self, prizes, added_by=None):
+        add_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.transaction() as conn:
+            conn.executemany('''INSERT INTO prizes (image, added_by, add_date, price, content_hash) VALUES (?, ?, ?, ?, ?)''', 
+                            [(image, added_by, add_date, price, content_hash) for image, price, content_hash in prizes])
 
-    def add_failed_prize(self, user_id, prize_id):
-        fail_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        conn = sqlite3.connect(self.database)
-        with conn:
-            conn.execute('''INSERT INTO failed_prizes (user_id, prize_id, fail_time) VALUES (?, ?, ?)''', 
-                        (user_id, prize_id, fail_time))
-            conn.commit()
+    def get_prize_by_hash(self, content_hash):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('SELECT prize_id FROM prizes WHERE content_hash = ?', (content_hash,))
+        result = cur.fetchone()
+        return result[0] if result else None
 
-    def add_coins(self, user_id, amount):
-        conn = sqlite3.connect(self.database)
+    def get_prize_hashes(self):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('SELECT prize_id, image FROM prizes WHERE content_hash IS NULL')
+        missing = []
+        for prize_id, image in cur.fetchall():
+            try:
+                with open(f'img/{image}', 'rb') as f:
+                    missing.append((hashlib.sha1(f.read()).hexdigest(), prize_id))
+            except OSError:
+                continue
+        if missing:
+            with self.transaction() as conn:
+                conn.executemany('UPDATE prizes SET content_hash = ? WHERE prize_id = ?', missing)
+        
+        cur = self.connect().cursor()
+        cur.execute('SELECT content_hash, image FROM prizes WHERE content_hash IS NOT NULL')
+        return dict(cur.fetchall())
+
+    def _record_win(self, conn, user_id, win_type, win_time):
+        if win_type == 'regular':
+            conn.execute('''INSERT INTO user_stats (user_id, prizes) VALUES (?, 1)
+                          ON CONFLICT(user_id) DO UPDATE SET prizes = prizes + 1''', (user_id,))
+            week = datetime.strptime(win_time, '%Y-%m-%d %H:%M:%S').strftime(WEEK_FORMAT)
+            conn.execute('''INSERT INTO user_weekly_stats (week, user_id, prizes) VALUES (?, ?, 1)
+                          ON CONFLICT(week, user_id) DO UPDATE SET prizes = prizes + 1''', (week, user_id))
+        else:
+            conn.execute('''INSERT INTO user_stats (user_id, purchases) VALUES (?, 1)
+                          ON CONFLICT(user_id) DO UPDATE SET purchases = purchases + 1''', (user_id,))
+
+    def add_winners_batch(self, winners):
+        counts = {}
+        with self.transaction() as conn:
+            for user_id, prize_id, max_winners, coins, win_time in winners:
+                if prize_id not in counts:
+                    counts[prize_id] = conn.execute("SELECT COUNT(*) FROM winners WHERE prize_id = ? AND win_type = 'regular'",
+                                                    (prize_id,)).fetchone()[0]
+                if counts[prize_id] >= max_winners:
+                    continue
+                cur = conn.execute('''INSERT OR IGNORE INTO winners (user_id, prize_id, win_time, win_type) VALUES (?, ?, ?, 'regular')''', 
+                                   (user_id, prize_id, win_time))
+                if not cur.rowcount:
+                    continue
+                counts[prize_id] += 1
+                self._record_win(conn, user_id, 'regular', win_time)
+                if coins:
+                    self._change_coins(conn, user_id, coins)
+
+    def _change_coins(self, conn, user_id, amount, action_type=None):
+        conn.execute('UPDATE users SET coins = coins + ? WHERE user_id = ?', (amount, user_id))
+        action_type = action_type or ('add_coins' if amount > 0 else 'spend_coins')
+        conn.execute('''INSERT INTO bonus_actions (user_id, action_type, coins_change, action_time) 
+                      VALUES (?, ?, ?, ?)''', 
+                    (user_id, action_type, amount, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    def add_coins(self, user_id, amount, action_type=None):
+        conn = self.connect()
         with conn:
-            conn.execute('UPDATE users SET coins = coins + ? WHERE user_id = ?', (amount, user_id))
-            action_type = 'add_coins' if amount > 0 else 'spend_coins'
-            conn.execute('''INSERT INTO bonus_actions (user_id, action_type, coins_change, action_time) 
-                          VALUES (?, ?, ?, ?)''', 
-                        (user_id, action_type, amount, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            self._change_coins(conn, user_id, amount, action_type)
             conn.commit()
 
+    def _segment_query(self, segment, value=None):
+        if segment == 'all':
+            return 'SELECT user_id FROM users', ()
+        if segment == 'active':
+            since = (datetime.now() - timedelta(days=value or 7)).strftime('%Y-%m-%d %H:%M:%S')
+            return 'SELECT user_id FROM users WHERE last_seen >= ?', (since,)
+        if segment == 'top':
+            return 'SELECT user_id FROM users ORDER BY coins DESC LIMIT ?', (value or 10,)
+        raise ValueError(f"Неизвестный сегмент: {segment}")
+
+    def add_coins_bulk(self, amount, segment='all', value=None, action_type='bulk_bonus'):
+        query, params = self._segment_query(segment, value)
+        action_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.transaction() as conn:
+            conn.execute('DROP TABLE IF EXISTS temp.bulk_targets')
+            conn.execute(f'CREATE TEMP TABLE bulk_targets AS SELECT DISTINCT user_id FROM ({query})', params)
+            cur = conn.execute('UPDATE users SET coins = coins + ? WHERE user_id IN (SELECT user_id FROM temp.bulk_targets)', 
+                               (amount,))
+            count = cur.rowcount
+            conn.execute('''INSERT INTO bonus_actions (user_id, action_type, coins_change, action_time)
+                          SELECT t.user_id, ?, ?, ? FROM temp.bulk_targets t JOIN users u ON u.user_id = t.user_id''', 
+                        (action_type, amount, action_time))
+            conn.execute('DROP TABLE temp.bulk_targets')
+        return count
+
     def get_coins(self, user_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         cur = conn.cursor()
         cur.execute('SELECT coins FROM users WHERE user_id = ?', (user_id,))
         result = cur.fetchone()
         return result[0] if result else 0
 
     def mark_prize_used(self, prize_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             conn.execute('UPDATE prizes SET used = 1 WHERE prize_id = ?', (prize_id,))
             conn.commit()
 
+    def start_drop(self, prize_id):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.transaction() as conn:
+            conn.execute('UPDATE prizes SET used = 1 WHERE prize_id = ?', (prize_id,))
+            cur = conn.execute('''INSERT OR IGNORE INTO outbox (prize_id, user_id, next_attempt_at) 
+                                  SELECT ?, user_id, ? FROM users WHERE active = 1''', (prize_id, now))
+        return cur.rowcount
+
+    def get_outbox_batch(self, limit=500):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('''SELECT o.prize_id, o.user_id, p.image, o.attempts FROM outbox o 
+                      JOIN prizes p ON p.prize_id = o.prize_id 
+                      WHERE o.status = 'pending' AND o.next_attempt_at <= ? 
+                      ORDER BY o.next_attempt_at LIMIT ?''', (now, limit))
+        return cur.fetchall()
+
+    def _record_failures(self, conn, user_ids, max_failures):
+        conn.executemany('''UPDATE users SET failures = failures + 1, 
+                           active = CASE WHEN failures + 1 >= ? THEN 0 ELSE active END 
+                           WHERE user_id = ?''', [(max_failures, user_id) for user_id in user_ids])
+
+    def mark_undeliverable(self, user_ids, max_failures=3):
+        with self.transaction() as conn:
+            self._record_failures(conn, user_ids, max_failures)
+
+    def complete_outbox(self, sent, failed, max_attempts=3, retry_delay=60, max_failures=3):
+        now = datetime.now()
+        next_attempt = (now + timedelta(seconds=retry_delay)).strftime('%Y-%m-%d %H:%M:%S')
+        permanent = [row for row in failed if row[2] in PERMANENT_ERRORS]
+        transient = [row for row in failed if row[2] not in PERMANENT_ERRORS]
+        with self.transaction() as conn:
+            conn.executemany('''UPDATE outbox SET status = 'sent', attempts = attempts + 1, error = NULL 
+                               WHERE prize_id = ? AND user_id = ?''', sent)
+            conn.executemany('UPDATE users SET failures = 0 WHERE user_id = ? AND failures > 0', 
+                             [(user_id,) for prize_id, user_id in sent])
+            conn.executemany('''UPDATE outbox SET status = 'failed', attempts = attempts + 1, error = ? 
+                               WHERE prize_id = ? AND user_id = ?''', 
+                             [(error, prize_id, user_id) for prize_id, user_id, error in permanent])
+            self._record_failures(conn, [user_id for prize_id, user_id, error in permanent], max_failures)
+            conn.executemany('''UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, error = ?, 
+                               status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END 
+                               WHERE prize_id = ? AND user_id = ?''', 
+                             [(next_attempt, error, max_attempts, prize_id, user_id) for prize_id, user_id, error in transient])
+            conn.executemany('''INSERT OR IGNORE INTO failed_prizes (user_id, prize_id, fail_time) 
+                               SELECT user_id, prize_id, ? FROM outbox 
+                               WHERE prize_id = ? AND user_id = ? AND status = 'failed' ''', 
+                             [(now.strftime('%Y-%m-%d %H:%M:%S'), prize_id, user_id) for prize_id, user_id, error in transient])
+
+    def prune_outbox(self, keep_drops=5):
+        with self.transaction() as conn:
+            cur = conn.execute('''DELETE FROM outbox WHERE prize_id IN (
+                                      SELECT prize_id FROM outbox GROUP BY prize_id HAVING SUM(status = 'pending') = 0
+                                  ) AND prize_id NOT IN (
+                                      SELECT DISTINCT prize_id FROM outbox ORDER BY prize_id DESC LIMIT ?
+                                  )''', (keep_drops,))
+            return cur.rowcount
+
+    def get_next_outbox_attempt(self):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'")
+        result = cur.fetchone()[0]
+        return datetime.strptime(result, '%Y-%m-%d %H:%M:%S') if result else None
+
+    def get_outbox_progress(self, limit=5):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('''SELECT prize_id, COUNT(*), SUM(status = 'sent'), SUM(status = 'pending'), SUM(status = 'failed'), 
+                      SUM(status = 'failed' AND error = 'blocked'), SUM(status = 'failed' AND error = 'not_found'), 
+                      SUM(error IS NOT NULL AND error NOT IN ('blocked', 'not_found')) 
+                      FROM outbox GROUP BY prize_id ORDER BY prize_id DESC LIMIT ?''', (limit,))
+        return cur.fetchall()
+
+    def get_file_id(self, image, hidden=False):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('SELECT file_id FROM prize_files WHERE image = ? AND hidden = ?', (image, int(hidden)))
+        result = cur.fetchone()
+        return result[0] if result else None
+
+    def set_file_id(self, image, hidden, file_id):
+        conn = self.connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO prize_files (image, hidden, file_id) VALUES (?, ?, ?)', 
+                        (image, int(hidden), file_id))
+            conn.commit()
+
+    def clear_file_id(self, image, hidden=None):
+        conn = self.connect()
+        with conn:
+            if hidden is None:
+                conn.execute('DELETE FROM prize_files WHERE image = ?', (image,))
+            else:
+                conn.execute('DELETE FROM prize_files WHERE image = ? AND hidden = ?', (image, int(hidden)))
+            conn.commit()
+
     def get_users(self):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         cur = conn.cursor()
-        cur.execute('SELECT user_id FROM users')
+        cur.execute('SELECT user_id FROM users WHERE active = 1')
         return [x[0] for x in cur.fetchall()]
 
-    def get_all_users(self):
-        conn = sqlite3.connect(self.database)
+    def get_all_users(self, limit=-1):
+        conn = self.connect()
         cur = conn.cursor()
-        cur.execute('SELECT user_id, user_name, coins FROM users ORDER BY coins DESC')
+        cur.execute('SELECT user_id, user_name, coins FROM users ORDER BY coins DESC LIMIT ?', (limit,))
         return cur.fetchall()
 
     def get_prize_img(self, prize_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         cur = conn.cursor()
         cur.execute('SELECT image FROM prizes WHERE prize_id = ?', (prize_id,))
         result = cur.fetchall()
         return result[0][0] if result else None
 
+    def is_prize_available(self, user_id, prize_id):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('''SELECT 1 FROM prizes p 
+                      LEFT JOIN failed_prizes fp ON fp.prize_id = p.prize_id AND fp.user_id = ? 
+                      WHERE p.prize_id = ? AND (p.used = 0 OR fp.user_id IS NOT NULL)''', (user_id, prize_id))
+        return cur.fetchone() is not None
+
     def get_random_prize(self):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         cur = conn.cursor()
         cur.execute('SELECT prize_id, image FROM prizes WHERE used = 0 ORDER BY RANDOM() LIMIT 1')
         result = cur.fetchall()
         return result[0] if result else None
 
-    def get_user_failed_prizes(self, user_id):
-        conn = sqlite3.connect(self.database)
+    def get_second_chance_targets(self):
+        conn = self.connect()
         cur = conn.cursor()
-        cur.execute('''SELECT DISTINCT p.prize_id, p.image 
-                      FROM failed_prizes fp 
-                      JOIN prizes p ON fp.prize_id = p.prize_id 
-                      WHERE fp.user_id = ? AND p.used = 0''', (user_id,))
+        cur.execute('''SELECT t.user_id, t.missed, p.prize_id, p.image FROM (
+                          SELECT fp.user_id, COUNT(*) AS missed, MAX(fp.prize_id) AS prize_id 
+                          FROM failed_prizes fp 
+                          JOIN users u ON u.user_id = fp.user_id AND u.active = 1 
+                          LEFT JOIN winners w ON w.user_id = fp.user_id AND w.prize_id = fp.prize_id 
+                          WHERE w.user_id IS NULL 
+                          GROUP BY fp.user_id
+                      ) t JOIN prizes p ON p.prize_id = t.prize_id''')
         return cur.fetchall()
 
     def get_unused_prizes_count(self):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         cur = conn.cursor()
         cur.execute('SELECT COUNT(*) FROM prizes WHERE used = 0')
         result = cur.fetchone()
         return result[0] if result else 0
 
     def get_winners_count(self, prize_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
-            cur.execute('SELECT COUNT(DISTINCT user_id) FROM winners WHERE prize_id = ?', (prize_id,))
+            cur.execute('SELECT COUNT(*) FROM winners WHERE prize_id = ?', (prize_id,))
             return cur.fetchall()[0][0]
 
-    def get_rating(self):
-        conn = sqlite3.connect(self.database)
-        with conn:
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT u.user_name, COUNT(w.user_id) as prize_count
-                FROM winners w
-                JOIN users u ON w.user_id = u.user_id
-                WHERE w.win_type = 'regular'
-                GROUP BY w.user_id
-                ORDER BY prize_count DESC
-                LIMIT 10
-            ''')
-            return cur.fetchall()
+    def get_prize_owners(self, prize_id):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('SELECT user_id, win_type FROM winners WHERE prize_id = ?', (prize_id,))
+        return cur.fetchall()
+
+    def get_rating(self, board='prizes', limit=10):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute(RATING_BOARDS[board][0], {'limit': limit, 'week': datetime.now().strftime(WEEK_FORMAT)})
+        return cur.fetchall()
+
+    def get_user_rank(self, user_id, board='prizes'):
+        _, value_query, rank_query = RATING_BOARDS[board]
+        params = {'user_id': user_id, 'week': datetime.now().strftime(WEEK_FORMAT)}
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute(value_query, params)
+        result = cur.fetchone()
+        params['value'] = result[0] if result else 0
+        cur.execute(rank_query, params)
+        return cur.fetchone()[0] + 1, params['value']
 
     def get_winners_img(self, user_id):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
             cur.execute(''' 
@@ -214,81 +738,300 @@ class DatabaseManager:
             return cur.fetchall()
 
     def get_all_prizes(self):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
-            try:
-                cur.execute('SELECT prize_id, image, used, price FROM prizes ORDER BY add_date DESC')
-            except sqlite3.OperationalError:
-                cur.execute('SELECT prize_id, image, used FROM prizes ORDER BY add_date DESC')
-                prizes = cur.fetchall()
-                return [(p[0], p[1], p[2], 50) for p in prizes]
+            cur.execute('SELECT prize_id, image, used, price FROM prizes ORDER BY add_date DESC')
             return cur.fetchall()
 
+    def is_bonus_time(self):
+        return self.get_bool_setting('bonus_time_enabled') and datetime.now().hour == self.get_int_setting('bonus_time_hour')
+
+    def _pricing_params(self, user_id):
+        return {
+            'user_id': user_id,
+            'failed_discount': min(100, self.get_int_setting('failed_prize_discount')),
+            'bonus_discount': min(100, self.get_int_setting('bonus_time_discount')) if self.is_bonus_time() else 0,
+        }
+
+    def _page(self, query, params, cursor, backward, limit):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute(query, dict(params, limit=limit + 1))
+        rows = cur.fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+            return rows, more, True
+        return rows, cursor is not None, more
+
+    def get_failed_prizes_page(self, user_id, cursor=None, backward=False, limit=5):
+        params = self._pricing_params(user_id)
+        params['cursor'] = cursor or 0
+        query = f'''SELECT p.prize_id, p.image, p.price, {PRICE_SQL} 
+                    FROM failed_prizes fp 
+                    JOIN prizes p ON p.prize_id = fp.prize_id 
+                    LEFT JOIN winners w ON w.user_id = fp.user_id AND w.prize_id = fp.prize_id 
+                    WHERE fp.user_id = :user_id AND w.user_id IS NULL AND fp.prize_id {'<' if backward else '>'} :cursor 
+                    ORDER BY fp.prize_id {'DESC' if backward else 'ASC'} LIMIT :limit'''
+        return self._page(query, params, cursor, backward, limit)
+
+    def get_shop_page(self, cursor=None, backward=False, limit=5):
+        price, prize_id = cursor or (-1, 0)
+        query = f'''SELECT prize_id, image, price FROM prizes 
+                    WHERE used = 0 AND (price, prize_id) {'<' if backward else '>'} (:price, :prize_id) 
+                    ORDER BY price {'DESC' if backward else 'ASC'}, prize_id {'DESC' if backward else 'ASC'} LIMIT :limit'''
+        return self._page(query, {'price': price, 'prize_id': prize_id}, cursor, backward, limit)
+
     def get_available_prizes(self):
-        conn = sqlite3.connect(self.database)
+        conn = self.connect()
         with conn:
             cur = conn.cursor()
-            try:
-                cur.execute('SELECT prize_id, image, price FROM prizes WHERE used = 0 ORDER BY price')
-            except sqlite3.OperationalError:
-                cur.execute('SELECT prize_id, image FROM prizes WHERE used = 0')
-                prizes = cur.fetchall()
-                return [(p[0], p[1], 50) for p in prizes]
+            cur.execute('SELECT prize_id, image, price FROM prizes WHERE used = 0 ORDER BY price')
             return cur.fetchall()
 
-    def buy_prize(self, user_id, prize_id):
-        conn = sqlite3.connect(self.database)
-        with conn:
-            cur = conn.cursor()
-            try:
-                cur.execute('SELECT price FROM prizes WHERE prize_id = ?', (prize_id,))
-            except sqlite3.OperationalError:
-                price = 50
-            else:
-                price_result = cur.fetchone()
-                if not price_result:
-                    return False, "Приз не найден"
-                price = price_result[0]
-            
-            cur.execute('SELECT coins FROM users WHERE user_id = ?', (user_id,))
-            coins_result = cur.fetchone()
+    def _buy_prize(self, conn, user_id, prize_id, params, win_time):
+        cur = conn.execute(f'''SELECT {PRICE_SQL}, p.used = 0 OR fp.user_id IS NOT NULL FROM prizes p 
+                              LEFT JOIN failed_prizes fp ON fp.prize_id = p.prize_id AND fp.user_id = :user_id 
+                              WHERE p.prize_id = :prize_id''', params)
+        price_result = cur.fetchone()
+        if not price_result:
+            return False, "Приз не найден"
+        price, available = price_result
+        if not available:
+            return False, "Этот приз нельзя купить"
+        
+        cur = conn.execute('SELECT 1 FROM winners WHERE user_id = ? AND prize_id = ?', (user_id, prize_id))
+        if cur.fetchone():
+            return False, "У тебя уже есть этот приз"
+        
+        cur = conn.execute('UPDATE users SET coins = coins - ? WHERE user_id = ? AND coins >= ?', (price, user_id, price))
+        if not cur.rowcount:
+            coins_result = conn.execute('SELECT coins FROM users WHERE user_id = ?', (user_id,)).fetchone()
             if not coins_result:
                 return False, "Пользователь не найден"
-            
-            user_coins = coins_result[0]
-            if user_coins < price:
-                return False, f"Недостаточно монет. Нужно: {price}, есть: {user_coins}"
-            
-            cur.execute('UPDATE users SET coins = coins - ? WHERE user_id = ?', (price, user_id))
-            win_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            cur.execute('''INSERT INTO winners (user_id, prize_id, win_time, win_type) 
-                          VALUES (?, ?, ?, 'purchase')''', (user_id, prize_id, win_time))
-            cur.execute('''INSERT INTO bonus_actions (user_id, action_type, coins_change, action_time) 
-                          VALUES (?, 'prize_purchase', ?, ?)''', 
-                       (user_id, -price, win_time))
-            conn.commit()
-            return True, "Приз успешно куплен!"
+            return False, f"Недостаточно монет. Нужно: {price}, есть: {coins_result[0]}"
+        
+        conn.execute('''INSERT INTO winners (user_id, prize_id, win_time, win_type) 
+                      VALUES (?, ?, ?, 'purchase')''', (user_id, prize_id, win_time))
+        self._record_win(conn, user_id, 'purchase', win_time)
+        conn.execute('''INSERT INTO bonus_actions (user_id, action_type, coins_change, action_time) 
+                      VALUES (?, 'prize_purchase', ?, ?)''', 
+                    (user_id, -price, win_time))
+        return True, f"Приз успешно куплен за {price} монет!"
+
+    def buy_prize(self, user_id, prize_id, request_id=None):
+        params = self._pricing_params(user_id)
+        params['prize_id'] = prize_id
+        win_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.transaction() as conn:
+            if request_id:
+                cur = conn.execute('SELECT success, message FROM purchase_requests WHERE request_id = ?', (request_id,))
+                previous = cur.fetchone()
+                if previous:
+                    return bool(previous[0]), previous[1]
+            success, message = self._buy_prize(conn, user_id, prize_id, params, win_time)
+            if request_id:
+                conn.execute('''INSERT INTO purchase_requests (request_id, user_id, prize_id, success, message, request_time) 
+                              VALUES (?, ?, ?, ?, ?, ?)''', (request_id, user_id, prize_id, int(success), message, win_time))
+        return success, message
+
+    def _load_settings(self):
+        settings = self.settings
+        if settings is None:
+            with self.settings_lock:
+                if self.settings is None:
+                    conn = self.connect()
+                    cur = conn.cursor()
+                    cur.execute('SELECT setting_key, setting_value FROM bot_settings')
+                    self.settings = dict(cur.fetchall())
+                settings = self.settings
+        return settings
+
+    def reload_settings(self):
+        with self.settings_lock:
+            self.settings = None
+        return self._load_settings()
+
+    def subscribe(self, key, callback):
+        self.subscribers.setdefault(key, []).append(callback)
 
     def set_setting(self, key, value):
-        conn = sqlite3.connect(self.database)
+        value = str(value)
+        conn = self.connect()
         with conn:
             conn.execute('INSERT OR REPLACE INTO bot_settings (setting_key, setting_value) VALUES (?, ?)', 
                         (key, value))
             conn.commit()
+        
+        settings = self._load_settings()
+        with self.settings_lock:
+            old_value = settings.get(key)
+            settings[key] = value
+        
+        if old_value != value:
+            for callback in self.subscribers.get(key, []):
+                try:
+                    callback(key, value)
+                except Exception as e:
+                    print(f"Ошибка обработчика настройки {key}: {e}")
 
     def get_setting(self, key, default=None):
-        conn = sqlite3.connect(self.database)
-        cur = conn.cursor()
-        cur.execute('SELECT setting_value FROM bot_settings WHERE setting_key = ?', (key,))
-        result = cur.fetchone()
-        return result[0] if result else default
+        return self._load_settings().get(key, default)
+
+    def get_int_setting(self, key, default=None):
+        if default is None:
+            default = DEFAULT_SETTINGS.get(key, 0)
+        try:
+            return int(self.get_setting(key, default))
+        except (TypeError, ValueError):
+            return int(default)
+
+    def get_bool_setting(self, key, default=None):
+        if default is None:
+            default = DEFAULT_SETTINGS.get(key, False)
+        value = self.get_setting(key)
+        if value is None:
+            return bool(default)
+        return str(value).lower() in ('true', '1', 'yes', 'on')
 
     def get_all_settings(self):
-        conn = sqlite3.connect(self.database)
+        return dict(self._load_settings())
+
+    def get_job_state(self, job_name):
+        conn = self.connect()
         cur = conn.cursor()
-        cur.execute('SELECT setting_key, setting_value FROM bot_settings')
-        return dict(cur.fetchall())
+        cur.execute('SELECT next_run, last_run FROM scheduled_jobs WHERE job_name = ?', (job_name,))
+        return cur.fetchone() or (None, None)
+
+    def set_job_state(self, job_name, next_run, last_run=None):
+        conn = self.connect()
+        with conn:
+            conn.execute('''INSERT INTO scheduled_jobs (job_name, next_run, last_run) VALUES (?, ?, ?)
+                          ON CONFLICT(job_name) DO UPDATE SET next_run = excluded.next_run, 
+                          last_run = COALESCE(excluded.last_run, last_run)''', 
+                        (job_name, next_run, last_run))
+            conn.commit()
+
+    def get_ledger_cursor(self):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('SELECT COALESCE(MAX(last_action_id), 0) FROM ledger_snapshots')
+        return cur.fetchone()[0]
+
+    def _apply_ledger(self, conn, limit):
+        cursor = conn.execute('SELECT COALESCE(MAX(last_action_id), 0) FROM ledger_snapshots').fetchone()[0]
+        params = {'cursor': cursor, 'limit': limit, 'now': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        count = conn.execute('''SELECT COUNT(*) FROM (SELECT action_id FROM bonus_actions 
+                               WHERE action_id > :cursor ORDER BY action_id LIMIT :limit)''', params).fetchone()[0]
+        if count:
+            conn.execute('''WITH chunk AS (SELECT action_id, user_id, coins_change FROM bonus_actions 
+                                          WHERE action_id > :cursor ORDER BY action_id LIMIT :limit) 
+                          INSERT INTO ledger_snapshots (user_id, balance, last_action_id, checked_at) 
+                          SELECT user_id, SUM(coins_change), MAX(action_id), :now FROM chunk WHERE true GROUP BY user_id 
+                          ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance, 
+                          last_action_id = excluded.last_action_id''', params)
+        return count
+
+    def apply_ledger_chunk(self, limit=5000):
+        with self.transaction() as conn:
+            return self._apply_ledger(conn, limit)
+
+    def reconcile_users(self, after_user_id=0, limit=5000):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.transaction() as conn:
+            while self._apply_ledger(conn, limit) == limit:
+                pass
+            rows = conn.execute('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', 
+                                (after_user_id, limit)).fetchall()
+            if not rows:
+                return 0, None, 0
+            last_user_id = rows[-1][0]
+            conn.execute('''INSERT INTO ledger_snapshots (user_id, checked_at, discrepancy) 
+                          SELECT u.user_id, ?, u.coins - COALESCE(s.balance, 0) FROM users u 
+                          LEFT JOIN ledger_snapshots s ON s.user_id = u.user_id 
+                          WHERE u.user_id > ? AND u.user_id <= ? 
+                          ON CONFLICT(user_id) DO UPDATE SET checked_at = excluded.checked_at, 
+                          discrepancy = excluded.discrepancy''', (now, after_user_id, last_user_id))
+            flagged = conn.execute('''SELECT COUNT(*) FROM ledger_snapshots 
+                                     WHERE discrepancy != 0 AND user_id > ? AND user_id <= ?''', 
+                                   (after_user_id, last_user_id)).fetchone()[0]
+        return len(rows), last_user_id, flagged
+
+    def get_ledger_discrepancies(self, limit=10):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('''SELECT s.user_id, u.user_name, u.coins, s.balance, s.discrepancy FROM ledger_snapshots s 
+                      LEFT JOIN users u ON u.user_id = s.user_id 
+                      WHERE s.discrepancy != 0 ORDER BY ABS(s.discrepancy) DESC LIMIT ?''', (limit,))
+        return cur.fetchall()
+
+    def get_ledger_snapshot(self, user_id):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('SELECT balance, last_action_id, checked_at, discrepancy FROM ledger_snapshots WHERE user_id = ?', 
+                    (user_id,))
+        return cur.fetchone()
+
+    def archive_ledger(self, archive_path, before_time, limit=5000):
+        conn = self.connect()
+        if conn.in_transaction:
+            conn.commit()
+        boundary = conn.execute('SELECT action_id FROM bonus_actions WHERE action_time >= ? ORDER BY action_id LIMIT 1', 
+                                (before_time,)).fetchone()
+        upto = self.get_ledger_cursor()
+        if boundary:
+            upto = min(upto, boundary[0] - 1)
+        
+        archive = sqlite3.connect(archive_path)
+        try:
+            archive.execute('PRAGMA synchronous=FULL')
+            archive.execute('''
+            CREATE TABLE IF NOT EXISTS bonus_actions (
+                action_id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                action_type TEXT,
+                coins_change INTEGER,
+                action_time TEXT
+            )
+            ''')
+            archive.execute('CREATE INDEX IF NOT EXISTS idx_archive_user ON bonus_actions(user_id, action_id)')
+            archive.commit()
+            
+            archived = 0
+            while True:
+                rows = conn.execute('''SELECT action_id, user_id, action_type, coins_change, action_time FROM bonus_actions 
+                                     WHERE action_id <= ? ORDER BY action_id LIMIT ?''', (upto, limit)).fetchall()
+                if not rows:
+                    break
+                with archive:
+                    archive.executemany('INSERT OR IGNORE INTO bonus_actions VALUES (?, ?, ?, ?, ?)', rows)
+                with self.transaction() as tx:
+                    cur = tx.execute('DELETE FROM bonus_actions WHERE action_id >= ? AND action_id <= ?', 
+                                     (rows[0][0], rows[-1][0]))
+                archived += cur.rowcount
+                if len(rows) < limit:
+                    break
+        finally:
+            archive.close()
+        return archived
+
+    def get_ledger_history(self, user_id, limit=20, archive_path=None):
+        conn = self.connect()
+        cur = conn.cursor()
+        query = '''SELECT action_id, action_type, coins_change, action_time FROM bonus_actions 
+                   WHERE user_id = ? ORDER BY action_id DESC LIMIT ?'''
+        cur.execute(query, (user_id, limit))
+        rows = cur.fetchall()
+        if len(rows) < limit and archive_path and os.path.exists(archive_path):
+            archive = sqlite3.connect(f'file:{archive_path}?mode=ro', uri=True)
+            try:
+                seen = {row[0] for row in rows}
+                rows += [row for row in archive.execute(query, (user_id, limit)) if row[0] not in seen][:limit - len(rows)]
+            finally:
+                archive.close()
+        return rows
 
     def is_admin(self, user_id):
         admins = self.get_setting('admins', '')
@@ -303,42 +1046,234 @@ class DatabaseManager:
             return True
         return False
 
-def hide_img(img_name):
+class ImagePool:
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 2
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='image')
+
+    def submit(self, func, *args, **kwargs):
+        return self.executor.submit(func, *args, **kwargs)
+
+    def map(self, func, items):
+        return list(self.executor.map(func, items))
+
+    def imap(self, func, items):
+        return self.executor.map(func, items)
+
+image_pool = ImagePool()
+
+def hide_img(img_name, blur=15, pixels=30):
     image = cv2.imread(f'img/{img_name}')
     if image is None:
         return False
     
-    blurred_image = cv2.GaussianBlur(image, (15, 15), 0)
-    pixelated_image = cv2.resize(blurred_image, (30, 30), interpolation=cv2.INTER_NEAREST)
+    blurred_image = cv2.GaussianBlur(image, (blur, blur), 0)
+    pixelated_image = cv2.resize(blurred_image, (pixels, pixels), interpolation=cv2.INTER_NEAREST)
     pixelated_image = cv2.resize(pixelated_image, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
-    cv2.imwrite(f'hidden_img/{img_name}', pixelated_image)
+    name, ext = os.path.splitext(img_name)
+    temp_path = f'hidden_img/.{name}.{os.getpid()}.{threading.get_ident()}.tmp{ext}'
+    if not cv2.imwrite(temp_path, pixelated_image):
+        return False
+    os.replace(temp_path, f'hidden_img/{img_name}')
     return True
 
-def create_collage(image_paths):
-    images = []
-    for path in image_paths:
-        image = cv2.imread(path)
-        if image is not None:
-            images.append(image)
-        else:
-            print(f"Ошибка загрузки: {path}")
+class HiddenImageCache:
+    def __init__(self, blur=15, pixels=30, manifest_path='hidden_img/.manifest.json'):
+        self.blur = blur
+        self.pixels = pixels
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        self.image_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.saved_time = 0.0
+        try:
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
 
-    if not images:
-        return None
+    def _key(self, data):
+        digest = hashlib.sha1(data).hexdigest()
+        return f'{digest}:{self.blur}:{self.pixels}'
 
-    num_images = len(images)
-    num_cols = floor(sqrt(num_images))
-    num_rows = ceil(num_images / num_cols)
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+            temp_path = f'{self.manifest_path}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self.manifest, f)
+            os.replace(temp_path, self.manifest_path)
+
+    def _image_lock(self, img_name):
+        with self.lock:
+            return self.image_locks.setdefault(img_name, threading.Lock())
+
+    def ensure(self, img_name, save=True):
+        with self._image_lock(img_name):
+            generated = self._ensure(img_name)
+        if generated and save:
+            self.save()
+        return generated
+
+    def _ensure(self, img_name):
+        source = f'img/{img_name}'
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+        
+        entry = self.manifest.get(img_name)
+        hidden_exists = os.path.exists(f'hidden_img/{img_name}')
+        params = f':{self.blur}:{self.pixels}'
+        if (entry and hidden_exists and entry['key'].endswith(params)
+                and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size):
+            return self._hit(entry)
+        
+        with open(source, 'rb') as f:
+            key = self._key(f.read())
+        if entry and hidden_exists and entry['key'] == key:
+            entry.update(mtime=stat.st_mtime, size=stat.st_size)
+            return self._hit(entry)
+        
+        started = time.perf_counter()
+        if not hide_img(img_name, self.blur, self.pixels):
+            return None
+        with self.lock:
+            self.misses += 1
+            self.manifest[img_name] = {'key': key, 'mtime': stat.st_mtime, 'size': stat.st_size, 
+                                       'seconds': time.perf_counter() - started}
+        return True
+
+    def _hit(self, entry):
+        with self.lock:
+            self.hits += 1
+            self.saved_time += entry.get('seconds', 0)
+        return False
+
+    def warm(self, img_names):
+        results = image_pool.map(lambda img: self.ensure(img, save=False), img_names)
+        self.save()
+        return [img for img, generated in zip(img_names, results) if generated]
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0
+        return (f"🖼 Кэш скрытых изображений: {hit_rate:.0f}% попаданий ({self.hits}/{total}), "
+                f"сэкономлено ~{self.saved_time:.2f} c")
+
+hidden_images = HiddenImageCache()
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+class ImportReport:
+    def __init__(self, source):
+        self.source = source
+        self.found = 0
+        self.duplicates = 0
+        self.added = []
+        self.hidden = 0
+        self.started = time.perf_counter()
+        self.elapsed = 0
+
+    def report(self):
+        return (f"📦 Импорт из {self.source}\n"
+                f"🔎 Найдено изображений: {self.found}\n"
+                f"♻️ Дубликатов: {self.duplicates}\n"
+                f"✅ Добавлено призов: {len(self.added)}\n"
+                f"🔒 Скрыто изображений: {self.hidden}\n"
+                f"⏱ Время: {self.elapsed:.1f} c")
+
+def _iter_import_source(source):
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            if os.path.isfile(path) and name.lower().endswith(IMAGE_EXTENSIONS):
+                with open(path, 'rb') as f:
+                    yield name, f.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+                if not info.is_dir() and name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield name, archive.read(info)
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source) as archive:
+            for member in archive:
+                name = os.path.basename(member.name)
+                if member.isfile() and name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield name, archive.extractfile(member).read()
+    else:
+        raise ValueError(f"Не удалось прочитать {source}: нужна папка, zip или tar архив")
+
+def import_prizes(manager, source, added_by=None, price=50, progress=None, progress_every=100):
+    report = ImportReport(source)
+    known = manager.get_prize_hashes()
+    in_place = os.path.abspath(source) == os.path.abspath('img')
+    os.makedirs('img', exist_ok=True)
+    rows = []
+    
+    for name, data in _iter_import_source(source):
+        report.found += 1
+        content_hash = hashlib.sha1(data).hexdigest()
+        if content_hash in known:
+            report.duplicates += 1
+        else:
+            if not in_place:
+                if os.path.exists(f'img/{name}'):
+                    name = f'{content_hash[:10]}_{name}'
+                with open(f'img/{name}', 'wb') as f:
+                    f.write(data)
+            known[content_hash] = name
+            rows.append((name, price, content_hash))
+        if progress and report.found % progress_every == 0:
+            progress(f"🔎 Обработано файлов: {report.found}, новых: {len(rows)}")
     
-    collage = np.zeros((num_rows * images[0].shape[0], num_cols * images[0].shape[1], 3), dtype=np.uint8)
+    if rows:
+        manager.add_prizes(rows, added_by)
+        if progress:
+            progress(f"💾 Добавлено призов: {len(rows)}, скрываю изображения...")
     
-    for i, image in enumerate(images):
-        row = i // num_cols
-        col = i % num_cols
-        collage[row*image.shape[0]:(row+1)*image.shape[0], 
-                col*image.shape[1]:(col+1)*image.shape[1], :] = image
+    report.added = [name for name, _, _ in rows]
+    for img in hidden_images.warm(report.added):
+        manager.clear_file_id(img, hidden=True)
+        report.hidden += 1
     
-    return collage
+    report.elapsed = time.perf_counter() - report.started
+    return report
+
+def _collage_grid(num_images):
+    num_cols = floor(sqrt(num_images))
+    num_rows = ceil(num_images / num_cols)
+    return num_rows, num_cols
+
+def collage_cell_size(count, cell_size, max_size=4096):
+    num_rows, num_cols = _collage_grid(count)
+    width, height = cell_size
+    if max_size:
+        scale = min(1, max_size / (width * num_cols), max_size / (height * num_rows))
+        width, height = max(1, int(width * scale)), max(1, int(height * scale))
+    return width, height
+
+def build_collage(images, count, cell_size, max_size=4096):
+    if not count:
+        return None
+
+    num_rows, num_cols = _collage_grid(count)
+    width, height = collage_cell_size(count, cell_size, max_size)
+    collage = np.zeros((num_rows * height, num_cols * width, 3), dtype=np.uint8)
+    i = 0
+    for image in images:
+        if image is None:
+            continue
+        row, col = divmod(i, num_cols)
+        cell = collage[row*height:(row+1)*height, col*width:(col+1)*width]
+        if image.shape[:2] == (height, width):
+            cell[:] = image
+        else:
+            cv2.resize(image, (width, height), dst=cell, interpolation=cv2.INTER_AREA)
+        i += 1
+    return collage if i else None
 
 if __name__ == '__main__':
     manager = DatabaseManager(DATABASE)
@@ -349,15 +1284,15 @@ if __name__ == '__main__':
     if not os.path.exists('hidden_img'):
         os.makedirs('hidden_img')
     
-    prizes_img = os.listdir('img')
-    if prizes_img:
-        existing_prizes = [x[1] for x in manager.get_all_prizes()] if manager.get_all_prizes() else []
-        for img in prizes_img:
-            if img not in existing_prizes:
-                manager.add_prize(img, None, 50)
-            hidden_path = f'hidden_img/{img}'
-            if not os.path.exists(hidden_path):
-                hide_img(img)
+    if len(sys.argv) > 2 and sys.argv[1] == 'import':
+        price = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+        print(import_prizes(manager, sys.argv[2], price=price, progress=print).report())
+        sys.exit()
+    
+    print(import_prizes(manager, 'img').report())
+    for img in hidden_images.warm(os.listdir('img')):
+        manager.clear_file_id(img, hidden=True)
+    print(hidden_images.report())
     
     manager.set_setting('send_interval_hours', '1')
     manager.set_setting('max_winners_per_prize', '3')
@@ -0,0 +1,80 @@
+import threading
+from datetime import datetime
+from logic import PERMANENT_ERRORS
+from broadcast import BroadcastStats, classify_error
+
+
+class OutboxWorker:
+    def __init__(self, manager, broadcaster, job, batch_size=500, max_attempts=3, retry_delay=60, max_failures=3, keep_drops=5):
+        self.manager = manager
+        self.broadcaster = broadcaster
+        self.job = job
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_failures = max_failures
+        self.keep_drops = keep_drops
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stats = None
+
+    def notify(self):
+        self.wakeup.set()
+
+    def drain(self):
+        stats = None
+        while True:
+            rows = self.manager.get_outbox_batch(self.batch_size)
+            if not rows:
+                break
+            stats = stats or BroadcastStats()
+            self.stats = stats
+            sent, failed = [], []
+
+            def deliver(row):
+                self.job(row)
+                sent.append(row[:2])
+
+            def on_error(row, e):
+                kind = classify_error(e)
+                if kind not in PERMANENT_ERRORS:
+                    print(f"Ошибка отправки пользователю {row[1]}: {e}")
+                failed.append((row[0], row[1], kind))
+
+            self.broadcaster.broadcast(rows, deliver, on_error, stats)
+            self.manager.complete_outbox(sent, failed, self.max_attempts, self.retry_delay, self.max_failures)
+        if stats:
+            pruned = self.manager.prune_outbox(self.keep_drops)
+            print(f"Очередь рассылки разобрана, удалено старых записей: {pruned}\n{stats.report()}")
+        return stats
+
+    def _idle_timeout(self):
+        next_attempt = self.manager.get_next_outbox_attempt()
+        if next_attempt is None:
+            return None
+        return max(0, (next_attempt - datetime.now()).total_seconds()) + 1
+
+    def run_forever(self):
+        while True:
+            try:
+                self.drain()
+            except Exception as e:
+                print(f"Ошибка очереди рассылки: {e}")
+            self.wakeup.wait(self._idle_timeout())
+            self.wakeup.clear()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run_forever, name='outbox', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def report(self):
+        lines = ["📬 Доставка призов:"]
+        for prize_id, total, sent, pending, failed, blocked, not_found, transient in self.manager.get_outbox_progress(self.keep_drops):
+            lines.append(f"• Приз #{prize_id}: доставлено {sent}/{total}, в очереди {pending}, ошибок {failed} "
+                         f"(заблокировали {blocked}, чат не найден {not_found}, временных сбоев {transient})")
+        if len(lines) == 1:
+            lines.append("• рассылок пока не было")
+        if self.stats:
+            lines.append(f"\nПоследний проход:\n{self.stats.report()}")
+        return "\n".join(lines)
@@ -0,0 +1,123 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class IntervalScheduler:
+    def __init__(self, manager, name, job, interval_key):
+        self.manager = manager
+        self.name = name
+        self.job = job
+        self.interval_key = interval_key
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = None
+        self.runs = 0
+        self.skipped = 0
+        self.lags = deque(maxlen=100)
+
+        next_run, last_run = manager.get_job_state(name)
+        self.last_scheduled = datetime.strptime(last_run, TIME_FORMAT) if last_run else None
+        self.next_run = datetime.strptime(next_run, TIME_FORMAT) if next_run else self.next_after(datetime.now())
+        self._save()
+        manager.subscribe(interval_key, self._on_interval_change)
+
+    def interval(self):
+        return timedelta(hours=max(1, self.manager.get_int_setting(self.interval_key)))
+
+    def next_after(self, moment):
+        return (moment + self.interval()).replace(microsecond=0)
+
+    def _save(self):
+        last_run = self.last_scheduled.strftime(TIME_FORMAT) if self.last_scheduled else None
+        self.manager.set_job_state(self.name, self.next_run.strftime(TIME_FORMAT), last_run)
+
+    def _on_interval_change(self, key, value):
+        with self.lock:
+            now = datetime.now()
+            self.next_run = max(self.next_after(self.last_scheduled or now), now)
+            self._save()
+        print(f"Расписание '{self.name}' изменено, следующий запуск: {self.next_run:%Y-%m-%d %H:%M}")
+        self.wakeup.set()
+
+    def _run(self, scheduled):
+        self.lags.append((datetime.now() - scheduled).total_seconds())
+        try:
+            self.job()
+        except Exception as e:
+            print(f"Ошибка задачи '{self.name}': {e}")
+        finally:
+            self.runs += 1
+
+    def _tick(self):
+        with self.lock:
+            now = datetime.now()
+            if self.next_run > now:
+                return (self.next_run - now).total_seconds()
+
+            scheduled = self.next_run
+            if self.running and not self.running.done():
+                self.skipped += 1
+                print(f"Задача '{self.name}' еще выполняется, запуск {scheduled:%H:%M} пропущен")
+            else:
+                self.running = self.executor.submit(self._run, scheduled)
+
+            self.last_scheduled = scheduled
+            self.next_run = self.next_after(scheduled)
+            while self.next_run <= now:
+                self.next_run = self.next_after(self.next_run)
+            self._save()
+            return 0
+
+    def run_forever(self):
+        while True:
+            wait = self._tick()
+            if wait:
+                self.wakeup.wait(min(wait, 60))
+                self.wakeup.clear()
+
+    def start(self):
+        thread = threading.Thread(target=self.run_forever, name=f'{self.name}-scheduler')
+        thread.start()
+        return thread
+
+    def report(self):
+        last_lag = self.lags[-1] if self.lags else 0
+        max_lag = max(self.lags) if self.lags else 0
+        status = "выполняется" if self.running and not self.running.done() else "ожидает"
+        return (f"⏰ Следующий запуск: {self.next_run:%Y-%m-%d %H:%M}\n"
+                f"🔄 Статус: {status}, запусков: {self.runs}, пропущено: {self.skipped}\n"
+                f"⏱ Задержка запуска (посл./макс.): {last_lag:.1f}/{max_lag:.1f} c")
+
+
+class DailyScheduler(IntervalScheduler):
+    def interval(self):
+        return timedelta(days=1)
+
+    def _on_interval_change(self, key, value):
+        with self.lock:
+            self.next_run = self.next_after(datetime.now())
+            self._save()
+        print(f"Расписание '{self.name}' изменено, следующий запуск: {self.next_run:%Y-%m-%d %H:%M}")
+        self.wakeup.set()
+
+    def _tick(self):
+        with self.lock:
+            now = datetime.now()
+            if now - self.next_run >= timedelta(hours=1):
+                self.skipped += 1
+                print(f"Запуск '{self.name}' {self.next_run:%Y-%m-%d %H:%M} пропущен: час уже прошел")
+                self.next_run = self.next_after(now)
+                self._save()
+        return super()._tick()
+
+    def next_after(self, moment):
+        hour = self.manager.get_int_setting(self.interval_key) % 24
+        candidate = moment.replace(hour=hour, minute=0, second=0, microsecond=0)
+        if candidate <= moment:
+            candidate += timedelta(days=1)
+        return candidate
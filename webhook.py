@@ -0,0 +1,61 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telebot import types
+
+
+class WebhookServer:
+    def __init__(self, dispatcher, host='0.0.0.0', port=8443, path='/webhook', secret=None):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret
+        self.received = 0
+        self.rejected = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def _handler_class(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != webhook.path:
+                    self._reply(404)
+                    return
+                if webhook.secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != webhook.secret:
+                    webhook.rejected += 1
+                    self._reply(403)
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    update = types.Update.de_json(self.rfile.read(length).decode('utf-8'))
+                except Exception:
+                    webhook.rejected += 1
+                    self._reply(400)
+                    return
+                webhook.received += 1
+                webhook.dispatcher.submit(update)
+                self._reply(200)
+
+            def _reply(self, code):
+                self.send_response(code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='webhook')
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()